@@ -0,0 +1,163 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ticks import ticks_ms, ticks_diff
+
+
+class QualityController():
+    """
+    Closed loop on the stream viewers of a FrameHub: every `period_ms` it
+    looks at how long the slowest viewer took to write a frame and at the
+    bytes/s sent to all of them, and moves the JPEG quality (10 best, 63
+    worst) to keep the frame time under 1000 / `target_fps` and the rate
+    under `max_bytes_s`. Only when the quality is at its limit for
+    `hysteresis` periods in a row does the frame size change, never above
+    the size set by the user.
+
+    step() must run while the camera is idle, FrameHub.hooks does that.
+    It is the only place the camera is changed: reset() and configure()
+    just record what the next step() applies. With neither target set the
+    controller leaves the camera alone.
+    """
+
+    def __init__(self, camera, hub, target_fps=0, max_bytes_s=0, quality=10, framesize=8,
+                 min_framesize=5, max_quality=40, period_ms=2000, hysteresis=3):
+        self.camera = camera
+        self.hub = hub
+        self.target_fps = target_fps
+        self.max_bytes_s = max_bytes_s
+        self.min_framesize = min_framesize
+        self.max_quality = max_quality
+        self.period_ms = period_ms
+        self.hysteresis = hysteresis
+
+        self.state = 'holding' if target_fps or max_bytes_s else 'off'
+        self.frame_ms = 0
+        self.bytes_s = 0
+        self._last = ticks_ms()
+        self._seen = {}
+        self._count = 0
+        self.reset(quality, framesize)
+        self._takeReset()
+
+    def reset(self, quality, framesize):
+        """ The user set the camera, it becomes the best the loop goes to """
+        self._reset = (quality, framesize)
+
+    def _takeReset(self):
+        pending = self._reset
+        if pending:
+            self._reset = None
+            self.best_quality, self.best_framesize = pending
+            self.quality, self.framesize = pending
+            self._count = 0
+
+    def configure(self, target_fps=None, max_bytes_s=None):
+        if target_fps is not None:
+            self.target_fps = target_fps
+        if max_bytes_s is not None:
+            self.max_bytes_s = max_bytes_s
+
+    def _measure(self, elapsed):
+        # Per viewer deltas since the last period
+        seen = {}
+        frame_ms = None
+        sent_bytes = 0
+        for viewer in list(self.hub.viewers):
+            sent, send_ms, nbytes = self._seen.get(viewer, (0, 0, 0))
+            seen[viewer] = (viewer.sent, viewer.send_ms, viewer.bytes)
+            frames = viewer.sent - sent
+            if frames > 0:
+                frame_ms = max(frame_ms or 0, (viewer.send_ms - send_ms) // frames)
+                sent_bytes += viewer.bytes - nbytes
+        self._seen = seen
+        return frame_ms, sent_bytes * 1000 // elapsed
+
+    def _apply(self, quality, framesize):
+        if quality != self.quality:
+            self.quality = quality
+            self.camera.quality(quality)
+        if framesize != self.framesize:
+            self.framesize = framesize
+            self.camera.framesize(framesize)
+
+    def step(self):
+        self._takeReset()
+        if not self.target_fps and not self.max_bytes_s:
+            if self.state != 'off':
+                # Turned off, back to what the user set
+                self.state = 'off'
+                self._apply(self.best_quality, self.best_framesize)
+        elif self.state == 'off':
+            self.state = 'holding'
+
+        elapsed = ticks_diff(ticks_ms(), self._last)
+        if elapsed < self.period_ms:
+            return
+        self._last = ticks_ms()
+        frame_ms, self.bytes_s = self._measure(elapsed)
+        if frame_ms is None or (not self.target_fps and not self.max_bytes_s):
+            # Nothing streamed or nothing to aim for
+            return
+        self.frame_ms = frame_ms
+
+        # Over budget, or comfortably under it (the band in between holds)
+        over = False
+        headroom = True
+        if self.target_fps:
+            budget_ms = 1000 // self.target_fps
+            over = over or frame_ms > budget_ms
+            headroom = headroom and frame_ms < budget_ms * 6 // 10
+        if self.max_bytes_s:
+            over = over or self.bytes_s > self.max_bytes_s
+            headroom = headroom and self.bytes_s < self.max_bytes_s * 6 // 10
+
+        quality, framesize = self.quality, self.framesize
+        if over:
+            self.state = 'degrading'
+            if quality < self.max_quality:
+                quality = min(quality + 5, self.max_quality)
+                self._count = 0
+            elif framesize > self.min_framesize:
+                self._count += 1
+                if self._count >= self.hysteresis:
+                    framesize -= 1
+                    self._count = 0
+        elif headroom:
+            self.state = 'improving'
+            if quality > self.best_quality:
+                quality = max(quality - 5, self.best_quality)
+                self._count = 0
+            elif framesize < self.best_framesize:
+                self._count += 1
+                if self._count >= self.hysteresis:
+                    # A bigger frame at the worst quality, then improve again
+                    framesize += 1
+                    quality = self.max_quality
+                    self._count = 0
+        else:
+            self.state = 'holding'
+            self._count = 0
+        self._apply(quality, framesize)
+
+    def status(self):
+        return {
+            'target_fps': self.target_fps,
+            'max_bytes_s': self.max_bytes_s,
+            'state': self.state,
+            'quality': self.quality,
+            'framesize': self.framesize,
+            'frame_ms': self.frame_ms,
+            'bytes_s': self.bytes_s
+        }
@@ -0,0 +1,113 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Route dispatch micro-benchmark: MicroWebSrv.GetRouteHandler (segment
+# trie + resolved route cache) against the previous linear regex scan.
+#
+#   python benchmarks/bench_routes.py [routes] [lookups]
+#   micropython benchmarks/bench_routes.py [routes] [lookups]
+
+import sys
+import re
+
+sys.path.insert(0, '.')
+from microWebSrv import MicroWebSrv
+from ticks import ticks_ms, ticks_diff
+
+
+def handler(httpClient, httpResponse, routeArgs=None):
+    pass
+
+
+def make_routes(n):
+    routes = [("/", "GET", handler),
+              ("/upy", "GET", handler),
+              ("/stream/<d>", "GET", handler),
+              ("/upy/<saturation>/<brightness>/<contrast>/<quality>/<vflip>/<hflip>/<framesize>", "GET", handler)]
+    i = 0
+    while len(routes) < n:
+        routes.append(("/api/v%d/item%d/<id>" % (i % 4, i), "GET", handler))
+        routes.append(("/static/page%d.html" % i, "GET", handler))
+        i += 1
+    return routes[:n]
+
+
+class LinearRouter():
+    # The dispatch MicroWebSrv used before the trie router
+
+    def __init__(self, routes):
+        self.routes = []
+        for route, method, func in routes:
+            names = []
+            regex = ''
+            for s in route.split('/'):
+                if s.startswith('<') and s.endswith('>'):
+                    names.append(s[1:-1])
+                    regex += '/(\\w*)'
+                elif s:
+                    regex += '/' + s
+            self.routes.append((method, func, names, re.compile(regex + '$')))
+
+    def GetRouteHandler(self, resUrl, method):
+        if resUrl.endswith('/'):
+            resUrl = resUrl[:-1]
+        for m, func, names, regex in self.routes:
+            if m == method:
+                match = regex.match(resUrl)
+                if match:
+                    args = {}
+                    for i, name in enumerate(names):
+                        value = match.group(i + 1)
+                        try:
+                            value = int(value)
+                        except:
+                            pass
+                        args[name] = value
+                    return (func, args or None)
+        return (None, None)
+
+
+def bench(router, urls, lookups):
+    start = ticks_ms()
+    n = len(urls)
+    for i in range(lookups):
+        router.GetRouteHandler(urls[i % n], "GET")
+    return ticks_diff(ticks_ms(), start)
+
+
+def main():
+    n_routes = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    routes = make_routes(n_routes)
+
+    # Mix of hot paths (answered from the cache) and unique snapshot URLs
+    hot = ["/upy", "/upy/2/2/2/10/0/0/8", "/api/v1/item%d/42" % (n_routes // 2 - 3),
+           "/static/page%d.html" % (n_routes // 2 - 3), "/logo.svg"]
+    unique = ["/stream/d%d" % i for i in range(1000)]
+
+    trie = MicroWebSrv(routeHandlers=list(routes))
+    nocache = MicroWebSrv(routeHandlers=list(routes))
+    nocache.RouteCacheSize = 0
+    linear = LinearRouter(routes)
+
+    print("%d routes, %d lookups per run" % (n_routes, lookups))
+    for name, urls in (("hot paths", hot), ("unique paths", unique)):
+        print("%-13s linear %6d ms   trie %6d ms   trie+cache %6d ms" % (
+            name,
+            bench(linear, urls, lookups),
+            bench(nocache, urls, lookups),
+            bench(trie, urls, lookups)))
+
+
+main()
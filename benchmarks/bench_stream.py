@@ -0,0 +1,334 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End-to-end streaming benchmark (CPython, Linux).
+
+Boots a camera server on localhost against a replay camera backend (see
+serve.py), drives it with concurrent snapshot pollers, MJPEG viewers and
+/upy control callers, and reports delivered fps per client, request
+latency percentiles, bytes/s and the peak memory of the server process:
+
+    python benchmarks/bench_stream.py --pollers 3 --viewers 2 --controls 1
+    python benchmarks/bench_stream.py --app picoweb --interpreter micropython
+    python benchmarks/bench_stream.py --json results.json
+
+Without --frames, a directory of synthetic frames sized for --framesize
+is generated and replayed.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from camerabackend import SyntheticCamera
+
+
+class Client():
+
+    def __init__(self, kind, host, port, path, interval):
+        self.kind = kind
+        self.host = host
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.latencies = []
+        self.frames = 0
+        self.not_modified = 0
+        self.rejected = 0
+        self.errors = 0
+        self.bytes = 0
+        self.elapsed = 0
+
+    def run(self, deadline):
+        start = time.monotonic()
+        try:
+            self._run(deadline)
+        except OSError:
+            self.errors += 1
+        self.elapsed = time.monotonic() - start
+
+    def _run(self, deadline):
+        raise NotImplementedError
+
+    def result(self):
+        elapsed = self.elapsed or 1
+        return {
+            'kind': self.kind,
+            'path': self.path,
+            'requests': len(self.latencies),
+            'frames': self.frames,
+            'not_modified': self.not_modified,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'fps': round(self.frames / elapsed, 2),
+            'bytes_per_s': int(self.bytes / elapsed),
+            'latency_ms': percentiles(self.latencies)
+        }
+
+
+class RequestClient(Client):
+    # Snapshot pollers and /upy callers: requests over a keep-alive connection
+
+    def _run(self, deadline):
+        sock = None
+        etag = None
+        n = 0
+        while time.monotonic() < deadline:
+            path = self.path.replace('<n>', str(n))
+            n += 1
+            req = 'GET %s HTTP/1.1\r\nHost: %s\r\n' % (path, self.host)
+            if etag:
+                req += 'If-None-Match: %s\r\n' % etag
+            sent = time.monotonic()
+            for attempt in range(2):
+                reused = sock is not None
+                try:
+                    if sock is None:
+                        sock = socket.create_connection((self.host, self.port), timeout=10)
+                        f = sock.makefile('rb')
+                    sock.sendall((req + '\r\n').encode())
+                    status, headers, body, keep = read_response(f)
+                except OSError:
+                    status = None
+                # The server may close an idle keep-alive connection, retry once
+                if status is not None or not reused:
+                    break
+                sock.close()
+                sock = None
+            self.latencies.append((time.monotonic() - sent) * 1000)
+            if status is None:
+                self.errors += 1
+                keep = False
+            elif status == 200:
+                if self.kind == 'poller':
+                    self.frames += 1
+                    etag = headers.get('etag')
+                self.bytes += len(body)
+            elif status == 304:
+                self.not_modified += 1
+            elif status == 503:
+                self.rejected += 1
+            else:
+                self.errors += 1
+            if not keep and sock:
+                sock.close()
+                sock = None
+            if self.interval:
+                time.sleep(self.interval / 1000)
+        if sock:
+            sock.close()
+
+
+class MjpegClient(Client):
+    # A multipart/x-mixed-replace viewer, latency is the time between frames
+
+    def _run(self, deadline):
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        f = sock.makefile('rb')
+        sock.sendall(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (self.path, self.host)).encode())
+        status, headers = read_head(f)
+        if status != 200:
+            self.errors += 1
+            sock.close()
+            return
+        last = time.monotonic()
+        while time.monotonic() < deadline:
+            length = None
+            while True:
+                line = f.readline()
+                if not line:
+                    sock.close()
+                    return
+                line = line.strip()
+                if line.lower().startswith(b'content-length'):
+                    length = int(line.split(b':', 1)[1])
+                elif not line and length is not None:
+                    break
+            self.bytes += len(f.read(length))
+            self.frames += 1
+            now = time.monotonic()
+            self.latencies.append((now - last) * 1000)
+            last = now
+        sock.close()
+
+
+def read_head(f):
+    line = f.readline()
+    if not line:
+        return None, {}
+    status = int(line.split()[1])
+    headers = {}
+    while True:
+        line = f.readline().strip()
+        if not line:
+            return status, headers
+        name, value = line.decode().split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+
+def read_response(f):
+    status, headers = read_head(f)
+    if status is None:
+        return None, headers, b'', False
+    body = b''
+    if 'content-length' in headers:
+        body = f.read(int(headers['content-length']))
+    keep = headers.get('connection', '').lower() == 'keep-alive'
+    if 'content-length' not in headers and status not in (204, 304):
+        body = f.read()
+        keep = False
+    return status, headers, body, keep
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    def at(p):
+        return round(values[min(len(values) - 1, int(len(values) * p / 100))], 2)
+    return {'p50': at(50), 'p95': at(95), 'p99': at(99), 'max': round(values[-1], 2)}
+
+
+def make_frames(framesize, quality, count=8):
+    path = tempfile.mkdtemp(prefix='upycam-frames-')
+    cam = SyntheticCamera(fps=0)
+    cam.framesize(framesize)
+    cam.quality(quality)
+    for i in range(count):
+        with open(os.path.join(path, 'frame%03d.jpg' % i), 'wb') as f:
+            f.write(cam.capture())
+    return path
+
+
+def peak_memory_kb(pid):
+    # Peak resident set size of the server process (Linux)
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def start_server(args, frames):
+    cmd = [args.interpreter, os.path.join('benchmarks', 'serve.py'), args.app,
+           str(args.port), 'replay', frames, str(args.fps)]
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE)
+    if proc.stdout.readline().strip() != b'ready':
+        proc.kill()
+        raise RuntimeError('Server failed to start: %s' % ' '.join(cmd))
+    # Wait until it accepts connections
+    for i in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', args.port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('Server not listening on port %d' % args.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--app', choices=('microwebsrv', 'picoweb'), default='microwebsrv')
+    parser.add_argument('--interpreter', default=sys.executable,
+                        help='runs the server (micropython for picoweb)')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--pollers', type=int, default=2, help='snapshot pollers')
+    parser.add_argument('--poll-ms', type=int, default=30, help='delay between snapshots')
+    parser.add_argument('--viewers', type=int, default=1, help='MJPEG viewers')
+    parser.add_argument('--controls', type=int, default=1, help='/upy callers')
+    parser.add_argument('--control-ms', type=int, default=250, help='delay between /upy calls')
+    parser.add_argument('--frames', help='directory of JPEG files to replay')
+    parser.add_argument('--framesize', type=int, default=8, help='synthetic frames size (8: VGA)')
+    parser.add_argument('--quality', type=int, default=10, help='synthetic frames quality')
+    parser.add_argument('--fps', type=int, default=25, help='replay camera fps')
+    parser.add_argument('--json', help='write the results to this file ("-" for stdout)')
+    args = parser.parse_args()
+
+    frames = args.frames or make_frames(args.framesize, args.quality)
+    if args.app == 'microwebsrv':
+        snapshot, mjpeg = '/stream/d<n>', '/mjpeg'
+    else:
+        snapshot, mjpeg = '/', '/?stream=true'
+        args.controls = 0   # the picoweb app has no settings API
+
+    clients = [RequestClient('poller', '127.0.0.1', args.port, snapshot, args.poll_ms)
+               for i in range(args.pollers)]
+    clients += [MjpegClient('viewer', '127.0.0.1', args.port, mjpeg, 0)
+                for i in range(args.viewers)]
+    clients += [RequestClient('control', '127.0.0.1', args.port, '/upy', args.control_ms)
+                for i in range(args.controls)]
+
+    proc = start_server(args, frames)
+    try:
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=c.run, args=(deadline, )) for c in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        memory = peak_memory_kb(proc.pid)
+    finally:
+        proc.kill()
+        proc.wait()
+
+    results = {
+        'app': args.app,
+        'interpreter': args.interpreter,
+        'duration_s': args.duration,
+        'camera_fps': args.fps,
+        'frame_bytes': os.path.getsize(os.path.join(frames, sorted(os.listdir(frames))[0])),
+        'peak_memory_kb': memory,
+        'bytes_per_s': sum(c.result()['bytes_per_s'] for c in clients),
+        'clients': [c.result() for c in clients]
+    }
+    for kind in ('poller', 'viewer', 'control'):
+        latencies = []
+        for c in clients:
+            if c.kind == kind:
+                latencies += c.latencies
+        results[kind + '_latency_ms'] = percentiles(latencies)
+
+    if args.json == '-':
+        print(json.dumps(results, indent=2))
+        return
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print('%s, %d s, camera %d fps, %d byte frames, peak memory %s kB, %d bytes/s' % (
+        args.app, args.duration, args.fps, results['frame_bytes'],
+        memory, results['bytes_per_s']))
+    for r in results['clients']:
+        print('  %-8s %-14s fps %6.2f  304 %4d  503 %4d  errors %3d  latency %s' % (
+            r['kind'], r['path'], r['fps'], r['not_modified'], r['rejected'], r['errors'],
+            r['latency_ms']))
+
+
+if __name__ == '__main__':
+    main()
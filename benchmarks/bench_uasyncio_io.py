@@ -0,0 +1,121 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# uasyncio I/O micro-benchmark: echoes a buffer over a loopback connection
+# and reports, per awrite/read cycle, the heap allocated and the calls the
+# event loop made to its poller.
+#
+#   micropython benchmarks/bench_uasyncio_io.py [cycles] [size] [port]
+#
+# Run from the repository root with the MicroPython unix port, the heap
+# figures come from gc.mem_alloc().
+
+import gc
+import sys
+
+sys.path.insert(0, '.')
+sys.path.insert(1, 'lib')
+import uasyncio as asyncio
+from ticks import ticks_ms, ticks_diff
+
+
+class CountingPoller():
+    # Stands in for the loop's poller, counting the calls made to it
+
+    def __init__(self, poller):
+        self.poller = poller
+        self.calls = {'register': 0, 'modify': 0, 'unregister': 0, 'ipoll': 0}
+
+    def register(self, obj, ev):
+        self.calls['register'] += 1
+        self.poller.register(obj, ev)
+
+    def modify(self, obj, ev):
+        self.calls['modify'] += 1
+        self.poller.modify(obj, ev)
+
+    def unregister(self, obj):
+        self.calls['unregister'] += 1
+        self.poller.unregister(obj)
+
+    def ipoll(self, delay, flags=0):
+        self.calls['ipoll'] += 1
+        return self.poller.ipoll(delay, flags)
+
+
+def echo(reader, writer):
+    buf = memoryview(bytearray(1024))
+    while True:
+        n = yield from reader.readinto(buf)
+        if not n:
+            break
+        yield from writer.awrite(buf, 0, n)
+    yield from writer.aclose()
+
+
+def cycle(reader, writer, out, mv):
+    yield from writer.awrite(out)
+    got = 0
+    while got < len(mv):
+        n = yield from reader.readinto(mv[got:] if got else mv)
+        if not n:
+            raise OSError('Connection closed')
+        got += n
+
+
+def client(port, cycles, size, poller, result):
+    reader, writer = yield from asyncio.open_connection('127.0.0.1', port)
+    out = bytearray(size)
+    mv = memoryview(bytearray(size))
+    # Warm up: connection set up, first registrations
+    for i in range(10):
+        yield from cycle(reader, writer, out, mv)
+
+    calls = dict(poller.calls)
+    gc.collect()
+    gc.disable()
+    heap = gc.mem_alloc() if hasattr(gc, 'mem_alloc') else None
+    start = ticks_ms()
+    for i in range(cycles):
+        yield from cycle(reader, writer, out, mv)
+    result['ms'] = ticks_diff(ticks_ms(), start)
+    if heap is not None:
+        result['heap'] = gc.mem_alloc() - heap
+    gc.enable()
+    for name in calls:
+        result[name] = poller.calls[name] - calls[name]
+    yield from writer.aclose()
+
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 8766
+
+    loop = asyncio.get_event_loop()
+    poller = CountingPoller(loop.poller)
+    loop.poller = poller
+    loop.create_task(asyncio.start_server(echo, '127.0.0.1', port))
+    result = {}
+    loop.run_until_complete(client(port, cycles, size, poller, result))
+
+    print('%d cycles of %d bytes in %d ms' % (cycles, size, result['ms']))
+    if 'heap' in result:
+        print('  heap bytes/cycle   %.1f' % (result['heap'] / cycles))
+    print('  poller calls/cycle register %.2f  modify %.2f  unregister %.2f  ipoll %.2f' % (
+        result['register'] / cycles, result['modify'] / cycles,
+        result['unregister'] / cycles, result['ipoll'] / cycles))
+
+
+main()
@@ -0,0 +1,104 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# uasyncio scheduler benchmark: hundreds of concurrent loopback clients
+# exchanging lines with an echo server, every read guarded by
+# wait_for_ms() like the keep-alive timeouts of the async MicroWebSrv.
+# Reports the request rate, how far the run and timer queues grew and
+# how many timeouts were cancelled instead of left to expire, and how
+# many connections each wake-up of the server accepted.
+#
+#   micropython benchmarks/bench_uasyncio_scale.py [clients] [rounds] [port]
+#
+# Run from the repository root with the MicroPython unix port, which
+# needs a file descriptor limit above twice the client count.
+
+import sys
+
+sys.path.insert(0, '.')
+sys.path.insert(1, 'lib')
+import uasyncio as asyncio
+from ticks import ticks_ms, ticks_diff
+
+TIMEOUT_MS = 5000
+
+stats = {'done': 0, 'requests': 0, 'errors': 0, 'runq': 0, 'timers': 0}
+
+
+def echo(reader, writer):
+    try:
+        while True:
+            line = yield from asyncio.wait_for_ms(reader.readline(), TIMEOUT_MS)
+            if not line:
+                break
+            yield from writer.awrite(line)
+    except asyncio.TimeoutError:
+        pass
+    yield from writer.aclose()
+
+
+def client(port, rounds):
+    try:
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', port)
+        for i in range(rounds):
+            yield from writer.awrite(b'ping %d\n' % i)
+            line = yield from asyncio.wait_for_ms(reader.readline(), TIMEOUT_MS)
+            if not line:
+                raise OSError('Connection closed')
+            stats['requests'] += 1
+        yield from writer.aclose()
+    except Exception:
+        stats['errors'] += 1
+    stats['done'] += 1
+
+
+def monitor(loop):
+    while True:
+        stats['runq'] = max(stats['runq'], len(loop.runq.buf))
+        stats['timers'] = max(stats['timers'], len(loop.waitq))
+        yield from asyncio.sleep_ms(10)
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 8767
+
+    loop = asyncio.get_event_loop()
+    server = asyncio.ServerStats()
+    loop.create_task(asyncio.start_server(echo, '127.0.0.1', port, backlog=clients,
+                                          stats=server))
+    loop.create_task(monitor(loop))
+
+    def run():
+        for i in range(clients):
+            loop.create_task(client(port, rounds))
+        while stats['done'] < clients:
+            yield from asyncio.sleep_ms(10)
+
+    start = ticks_ms()
+    loop.run_until_complete(run())
+    ms = ticks_diff(ticks_ms(), start) or 1
+
+    print('%d clients x %d rounds in %d ms, %d requests/s, %d errors' % (
+        clients, rounds, ms, stats['requests'] * 1000 // ms, stats['errors']))
+    print('  run queue grew to %d entries, at most %d timers pending' % (
+        stats['runq'], stats['timers']))
+    print('  %d timeouts cancelled, %d still pending' % (
+        loop.waitq.cancelled, len(loop.waitq)))
+    print('  %d connections accepted in %d wake-ups, at most %d at once' % (
+        server.accepted, server.wakeups, server.batch_max))
+
+
+main()
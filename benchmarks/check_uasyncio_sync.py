@@ -0,0 +1,208 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Behaviour checks of the bundled uasyncio Queue, Event, Semaphore and
+# Lock: blocking and overwrite-on-full queues, waiters woken in arrival
+# order, and waiters cancelled or timed out while parked. Each check runs
+# on the event loop and prints "ok <name>", a failed assert stops the run.
+#
+#   micropython benchmarks/check_uasyncio_sync.py
+#
+# Run from the repository root with the MicroPython unix port.
+
+import sys
+
+sys.path.insert(0, '.')
+sys.path.insert(1, 'lib')
+import uasyncio as asyncio
+from uasyncio.queues import Queue, QueueEmpty, QueueFull
+from uasyncio.synchro import Event, Semaphore, Lock
+
+loop = asyncio.get_event_loop()
+
+
+def check_queue():
+    q = Queue(2)
+    got = []
+
+    def consumer(n):
+        for i in range(n):
+            got.append((yield from q.get()))
+
+    task = loop.create_task(consumer(4))
+    for i in range(4):
+        # Blocks while 2 items are queued
+        yield from q.put(i)
+    yield from task
+    assert got == [0, 1, 2, 3]
+    assert q.empty()
+    try:
+        q.get_nowait()
+        assert False
+    except QueueEmpty:
+        pass
+    q.put_nowait(0)
+    q.put_nowait(1)
+    assert q.full()
+    try:
+        q.put_nowait(2)
+        assert False
+    except QueueFull:
+        pass
+
+
+def check_queue_overwrite():
+    q = Queue(2, overwrite=True)
+    assert q.put_nowait(0) is None
+    assert q.put_nowait(1) is None
+    # Full: the oldest item makes room and is handed back
+    assert q.put_nowait(2) == 0
+    assert (yield from q.put(3)) == 1
+    assert q.qsize() == 2 and q.dropped == 2
+    assert (yield from q.get()) == 2
+    assert (yield from q.get()) == 3
+
+
+def check_queue_get_cancelled():
+    # A getter cancelled after being woken passes the item to the next one
+    q = Queue()
+    got = []
+
+    def consumer(name):
+        got.append((name, (yield from q.get())))
+
+    first = loop.create_task(consumer('a'))
+    loop.create_task(consumer('b'))
+    yield from asyncio.sleep_ms(5)
+    q.put_nowait(1)
+    first.cancel()
+    yield from asyncio.sleep_ms(5)
+    assert first.cancelled()
+    assert got == [('b', 1)]
+    assert not q._getters
+
+
+def check_queue_get_timeout():
+    q = Queue()
+    try:
+        yield from asyncio.wait_for_ms(q.get(), 10)
+        assert False
+    except asyncio.TimeoutError:
+        pass
+    # The timed out getter left, the item stays queued
+    assert not q._getters
+    q.put_nowait(1)
+    assert q.qsize() == 1
+
+
+def check_event():
+    e = Event()
+    tasks = [loop.create_task(e.wait()) for i in range(3)]
+    yield from asyncio.sleep_ms(5)
+    assert not any(task.done() for task in tasks)
+    # Wakes the current waiters only
+    e.set()
+    e.clear()
+    assert (yield from asyncio.gather(*tasks)) == [True, True, True]
+    try:
+        yield from asyncio.wait_for_ms(e.wait(), 10)
+        assert False
+    except asyncio.TimeoutError:
+        pass
+    assert not e._waiters
+    e.set()
+    assert (yield from e.wait())
+
+
+def check_semaphore_order():
+    s = Semaphore(1)
+    order = []
+
+    def user(i):
+        yield from s.acquire()
+        order.append(i)
+        yield from asyncio.sleep_ms(5)
+        s.release()
+
+    yield from s.acquire()
+    tasks = []
+    for i in range(4):
+        tasks.append(loop.create_task(user(i)))
+        # Queue up in a known order
+        yield from asyncio.sleep_ms(1)
+    s.release()
+    yield from asyncio.gather(*tasks)
+    # Permits went to the waiters in their arrival order
+    assert order == [0, 1, 2, 3]
+    assert s.value == 1 and not s._waiters
+
+
+def check_semaphore_cancelled():
+    # A waiter cancelled after being handed the permit passes it on
+    s = Semaphore(1)
+    held = []
+
+    def user(name):
+        yield from s.acquire()
+        held.append(name)
+
+    yield from s.acquire()
+    first = loop.create_task(user('a'))
+    loop.create_task(user('b'))
+    yield from asyncio.sleep_ms(5)
+    s.release()
+    first.cancel()
+    yield from asyncio.sleep_ms(5)
+    assert first.cancelled()
+    assert held == ['b'] and s.locked()
+
+
+def check_lock():
+    lock = Lock()
+    inside = []
+
+    def user(i):
+        yield from lock.acquire()
+        inside.append(i)
+        assert len(inside) == 1
+        yield from asyncio.sleep_ms(2)
+        inside.remove(i)
+        lock.release()
+
+    yield from asyncio.gather(*[user(i) for i in range(4)])
+    assert not lock.locked()
+    yield from lock.acquire()
+    try:
+        yield from asyncio.wait_for_ms(lock.acquire(), 10)
+        assert False
+    except asyncio.TimeoutError:
+        pass
+    assert not lock._waiters
+    lock.release()
+
+
+CHECKS = (check_queue, check_queue_overwrite, check_queue_get_cancelled,
+          check_queue_get_timeout, check_event, check_semaphore_order,
+          check_semaphore_cancelled, check_lock)
+
+
+def main():
+    for check in CHECKS:
+        yield from check()
+        print('ok', check.__name__)
+    # Nothing left behind
+    assert not loop.tasks
+
+
+loop.run_until_complete(main())
@@ -0,0 +1,190 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Behaviour checks of the bundled uasyncio Task and gather(): results,
+# exceptions, cancellation before and while running, and timeouts. Each
+# check runs on the event loop and prints "ok <name>", a failed assert
+# stops the run.
+#
+#   micropython benchmarks/check_uasyncio_tasks.py
+#
+# Run from the repository root with the MicroPython unix port.
+
+import sys
+
+sys.path.insert(0, '.')
+sys.path.insert(1, 'lib')
+import uasyncio as asyncio
+
+loop = asyncio.get_event_loop()
+
+
+def work(log, name, ms, fail=False):
+    try:
+        yield from asyncio.sleep_ms(ms)
+    except asyncio.CancelledError:
+        log.append('cancelled ' + name)
+        raise
+    if fail:
+        raise ValueError(name)
+    log.append('done ' + name)
+    return name
+
+
+def check_join():
+    log = []
+    task = loop.create_task(work(log, 'a', 20))
+    done = []
+    task.add_done_callback(done.append)
+    assert not task.done()
+    assert (yield from task.join()) == 'a'
+    assert task.done() and not task.cancelled()
+    assert task.result() == 'a'
+    assert done == [task]
+    # Waiting on the task itself is the same as join()
+    assert (yield from loop.create_task(work(log, 'b', 5))) == 'b'
+    # A callback added once it ended runs at once
+    task.add_done_callback(done.append)
+    assert done == [task, task]
+
+
+def check_exception():
+    log = []
+    task = loop.create_task(work(log, 'a', 5, fail=True))
+    try:
+        yield from task
+        assert False
+    except ValueError as e:
+        assert e.args == ('a',)
+    try:
+        task.result()
+        assert False
+    except ValueError:
+        pass
+    assert not task.cancelled()
+
+
+def check_gather():
+    log = []
+    # Results in the order of the arguments, not of completion
+    res = yield from asyncio.gather(work(log, 'a', 30), work(log, 'b', 10),
+                                    loop.create_task(work(log, 'c', 20)))
+    assert res == ['a', 'b', 'c']
+    assert log == ['done b', 'done c', 'done a']
+
+
+def check_gather_exception():
+    log = []
+    try:
+        yield from asyncio.gather(work(log, 'a', 50), work(log, 'b', 10, fail=True),
+                                  work(log, 'c', 50))
+        assert False
+    except ValueError as e:
+        assert e.args == ('b',)
+    # The others were cancelled
+    yield from asyncio.sleep_ms(100)
+    assert sorted(log) == ['cancelled a', 'cancelled c']
+
+    log = []
+    res = yield from asyncio.gather(work(log, 'a', 10, fail=True), work(log, 'b', 5),
+                                    return_exceptions=True)
+    assert isinstance(res[0], ValueError) and res[1] == 'b'
+
+
+def check_cancel():
+    log = []
+    task = loop.create_task(work(log, 'a', 10))
+    yield from asyncio.sleep_ms(0)
+    assert task.cancel()
+    try:
+        yield from task
+        assert False
+    except asyncio.CancelledError:
+        pass
+    assert task.done() and task.cancelled()
+    assert log == ['cancelled a']
+    # Cancelling an ended task does nothing
+    assert not task.cancel()
+
+
+def check_cancel_before_start():
+    log = []
+    task = loop.create_task(work(log, 'a', 10))
+    assert task.cancel()
+    try:
+        yield from task
+        assert False
+    except asyncio.CancelledError:
+        pass
+    assert task.cancelled()
+    # It never ran
+    assert log == []
+
+
+def check_cancel_gather():
+    log = []
+    group = loop.create_task(asyncio.gather(work(log, 'a', 50), work(log, 'b', 50)))
+    yield from asyncio.sleep_ms(10)
+    group.cancel()
+    try:
+        yield from group
+        assert False
+    except asyncio.CancelledError:
+        pass
+    assert group.cancelled()
+    yield from asyncio.sleep_ms(100)
+    assert sorted(log) == ['cancelled a', 'cancelled b']
+
+
+def check_timeout():
+    log = []
+    task = loop.create_task(work(log, 'a', 100))
+    try:
+        yield from asyncio.wait_for_ms(task.join(), 20)
+        assert False
+    except asyncio.TimeoutError:
+        pass
+    # Only the wait timed out, the task goes on without its waiter
+    assert not task.done() and not task._waiters
+    assert (yield from task) == 'a'
+    # A timeout cancels the coroutine it wraps
+    try:
+        yield from asyncio.wait_for_ms(work(log, 'b', 100), 20)
+        assert False
+    except asyncio.TimeoutError:
+        pass
+    assert log == ['done a', 'cancelled b']
+
+
+def check_unjoined_exception():
+    # Kept by the task instead of stopping the loop, printed as nobody waits
+    task = loop.create_task(work([], 'a', 1, fail=True))
+    yield from asyncio.sleep_ms(10)
+    assert task.done() and isinstance(task._exc, ValueError)
+
+
+CHECKS = (check_join, check_exception, check_gather, check_gather_exception,
+          check_cancel, check_cancel_before_start, check_cancel_gather,
+          check_timeout, check_unjoined_exception)
+
+
+def main():
+    for check in CHECKS:
+        yield from check()
+        print('ok', check.__name__)
+    # Nothing left behind
+    assert not loop.tasks
+
+
+loop.run_until_complete(main())
@@ -0,0 +1,69 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Boots one of the camera servers off-device for bench_stream.py:
+#
+#   python serve.py microwebsrv <port> <backend> [replay_dir] [fps]
+#   micropython serve.py picoweb <port> <backend> [replay_dir] [fps]
+#
+# Run from the repository root. The picoweb app needs MicroPython with
+# picoweb and ulogging installed.
+
+import sys
+import time
+
+sys.path.insert(0, '.')
+sys.path.insert(1, 'lib')
+
+app = sys.argv[1]
+port = int(sys.argv[2])
+app_config = {
+    'camera': 'ESP32-CAM',
+    'led': 4,
+    'backend': sys.argv[3],
+    'replay_dir': sys.argv[4] if len(sys.argv) > 4 else None,
+    'fps': int(sys.argv[5]) if len(sys.argv) > 5 else 25
+}
+
+
+def ready():
+    print('ready')
+    if hasattr(sys.stdout, 'flush'):
+        sys.stdout.flush()
+
+
+if app == 'microwebsrv':
+    from webserver import webcam
+    webcam().run(app_config, port=port)
+    ready()
+    while True:
+        time.sleep(1)
+
+elif app == 'picoweb':
+    # webcam.py reads app_config from the config module
+    import os
+    path = '/tmp/upycam-bench'
+    try:
+        os.mkdir(path)
+    except OSError:
+        pass
+    with open(path + '/config.py', 'w') as f:
+        f.write('app_config = %r\n' % app_config)
+    sys.path.insert(0, path)
+    import webcam
+    ready()
+    webcam.run(port=port)
+
+else:
+    raise ValueError('Unknown app: %s' % app)
@@ -0,0 +1,242 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+
+from ticks import ticks_ms, ticks_diff, ticks_add, sleep_ms
+
+# Same values as the camera module FRAME_* constants
+FRAME_96X96 = 0
+FRAME_QQVGA = 1
+FRAME_QCIF = 2
+FRAME_HQVGA = 3
+FRAME_240X240 = 4
+FRAME_QVGA = 5
+FRAME_CIF = 6
+FRAME_HVGA = 7
+FRAME_VGA = 8
+FRAME_SVGA = 9
+FRAME_XGA = 10
+FRAME_HD = 11
+FRAME_SXGA = 12
+FRAME_UXGA = 13
+
+RESOLUTIONS = [(96, 96), (160, 120), (176, 144), (240, 176), (240, 240),
+               (320, 240), (400, 296), (480, 320), (640, 480), (800, 600),
+               (1024, 768), (1280, 720), (1280, 1024), (1600, 1200)]
+
+
+class CameraBackend():
+    """
+    Interface of the camera module used by the servers: init, capture,
+    deinit and the sensor setters. capture() returns the JPEG as bytes,
+    or False on failure, like camera.capture().
+    """
+
+    def __init__(self):
+        self.settings = {
+            'framesize': FRAME_VGA,
+            'quality': 10,
+            'saturation': 0,
+            'brightness': 0,
+            'contrast': 0,
+            'flip': 0,
+            'mirror': 0
+        }
+
+    def init(self, framesize=None):
+        if framesize is not None:
+            self.settings['framesize'] = framesize
+        return True
+
+    def deinit(self):
+        pass
+
+    def capture(self):
+        raise NotImplementedError
+
+    def framesize(self, value):
+        self.settings['framesize'] = value
+
+    def quality(self, value):
+        self.settings['quality'] = value
+
+    def saturation(self, value):
+        self.settings['saturation'] = value
+
+    def brightness(self, value):
+        self.settings['brightness'] = value
+
+    def contrast(self, value):
+        self.settings['contrast'] = value
+
+    def flip(self, value):
+        self.settings['flip'] = value
+
+    def mirror(self, value):
+        self.settings['mirror'] = value
+
+
+class EspCamera(CameraBackend):
+    # The camera module of the lemariva/micropython-camera-driver firmware
+
+    def __init__(self, board):
+        CameraBackend.__init__(self)
+        import camera
+        self._camera = camera
+        self.board = board
+
+    def init(self, framesize=None):
+        CameraBackend.init(self, framesize)
+        camera = self._camera
+        kwargs = {'format': camera.JPEG}
+        if framesize is not None:
+            kwargs['framesize'] = framesize
+        if self.board == 'M5CAMERA':
+            kwargs.update(d0=32, d1=35, d2=34, d3=5, d4=39, d5=18, d6=36, d7=19,
+                          href=26, vsync=25, reset=15, sioc=23, siod=22, xclk=27, pclk=21)
+        return camera.init(0, **kwargs)
+
+    def deinit(self):
+        self._camera.deinit()
+
+    def capture(self):
+        return self._camera.capture()
+
+    def framesize(self, value):
+        CameraBackend.framesize(self, value)
+        self._camera.framesize(value)
+
+    def quality(self, value):
+        CameraBackend.quality(self, value)
+        self._camera.quality(value)
+
+    def saturation(self, value):
+        CameraBackend.saturation(self, value)
+        self._camera.saturation(value)
+
+    def brightness(self, value):
+        CameraBackend.brightness(self, value)
+        self._camera.brightness(value)
+
+    def contrast(self, value):
+        CameraBackend.contrast(self, value)
+        self._camera.contrast(value)
+
+    def flip(self, value):
+        CameraBackend.flip(self, value)
+        self._camera.flip(value)
+
+    def mirror(self, value):
+        CameraBackend.mirror(self, value)
+        self._camera.mirror(value)
+
+
+class PacedCamera(CameraBackend):
+    """
+    Base of the off-device backends: capture() blocks until the next frame
+    slot like the sensor does, `jitter_ms` adds up to that much random
+    delay and `fail_rate` (0..1) of the captures return False.
+    """
+
+    def __init__(self, fps=25, jitter_ms=0, fail_rate=0):
+        CameraBackend.__init__(self)
+        self.fps = fps
+        self.jitter_ms = jitter_ms
+        self.fail_rate = fail_rate
+        self.captures = 0
+        self._next = None
+
+    def _pace(self):
+        now = ticks_ms()
+        if self._next is None or ticks_diff(now, self._next) > 0:
+            self._next = now
+        delay = ticks_diff(self._next, now)
+        if self.jitter_ms:
+            delay += random.getrandbits(16) * self.jitter_ms // 65536
+        if delay > 0:
+            sleep_ms(delay)
+        if self.fps > 0:
+            self._next = ticks_add(self._next, 1000 // self.fps)
+
+    def _failed(self):
+        return self.fail_rate > 0 and \
+            random.getrandbits(16) < int(self.fail_rate * 65536)
+
+    def capture(self):
+        self._pace()
+        self.captures += 1
+        if self._failed():
+            return False
+        return self._frame()
+
+    def _frame(self):
+        raise NotImplementedError
+
+
+class ReplayCamera(PacedCamera):
+    # Replays the .jpg files of a directory in name order, looping
+
+    def __init__(self, path, fps=25, jitter_ms=0, fail_rate=0):
+        PacedCamera.__init__(self, fps, jitter_ms, fail_rate)
+        self.path = path
+        self._files = sorted(f for f in os.listdir(path)
+                             if f.lower().endswith('.jpg') or f.lower().endswith('.jpeg'))
+        if not self._files:
+            raise OSError('No JPEG files in %s' % path)
+        self._index = 0
+
+    def _frame(self):
+        name = self._files[self._index]
+        self._index = (self._index + 1) % len(self._files)
+        with open(self.path + '/' + name, 'rb') as f:
+            return f.read()
+
+
+class SyntheticCamera(PacedCamera):
+    """
+    Generates JPEG-framed buffers sized like the sensor output for the
+    current framesize and quality (about 0.12 bytes per pixel at quality
+    10 down to 0.025 at quality 63).
+    """
+
+    def _frame(self):
+        w, h = RESOLUTIONS[min(self.settings['framesize'], len(RESOLUTIONS) - 1)]
+        quality = min(max(self.settings['quality'], 10), 63)
+        size = w * h * (12000 - (quality - 10) * 9500 // 53) // 100000
+        stamp = ('frame %d' % self.captures).encode()
+        return b'\xff\xd8' + stamp + bytes(max(size - len(stamp) - 4, 0)) + b'\xff\xd9'
+
+
+def get_camera(app_config):
+    """
+    Camera backend selected by app_config['backend']:
+        'camera'    (default) the ESP32 camera module, app_config['camera']
+                    names the board
+        'replay'    JPEG files of app_config['replay_dir']
+        'synthetic' generated frames
+    'fps', 'jitter_ms' and 'fail_rate' configure the off-device backends.
+    """
+    backend = app_config.get('backend', 'camera')
+    fps = app_config.get('fps', 25)
+    jitter_ms = app_config.get('jitter_ms', 0)
+    fail_rate = app_config.get('fail_rate', 0)
+    if backend == 'camera':
+        return EspCamera(app_config.get('camera', 'ESP32-CAM'))
+    if backend == 'replay':
+        return ReplayCamera(app_config['replay_dir'], fps, jitter_ms, fail_rate)
+    if backend == 'synthetic':
+        return SyntheticCamera(fps, jitter_ms, fail_rate)
+    raise ValueError('Unknown camera backend: %s' % backend)
@@ -0,0 +1,102 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uasyncio as asyncio
+from uasyncio.synchro import Event
+
+from ticks import ticks_ms, ticks_diff
+
+
+class CameraSession():
+    """
+    Keeps the sensor initialised while it is used. acquire() initialises
+    and warms it up only when it is cold, requests arriving meanwhile wait
+    for that same start-up, and release() hands it back. arun() turns the
+    sensor off once nobody used it for `idle_ms`, so in steady state a
+    snapshot costs a single capture.
+    """
+
+    def __init__(self, camera, idle_ms=30000, warmup_ms=2000, poll_ms=100, on_deinit=None):
+        self.camera = camera
+        self.idle_ms = idle_ms
+        self.warmup_ms = warmup_ms
+        self.poll_ms = poll_ms
+        self.on_deinit = on_deinit
+
+        self.users = 0
+        self.warm = False
+        self._starting = None   # Event set once the start-up in progress ends
+        self._last = ticks_ms()
+
+        self.inits = 0
+        self.warm_hits = 0
+
+    def _init(self):
+        # Camera resilience - if we fail to init try to deinit and init again
+        if self.camera.init():
+            return True
+        self.camera.deinit()
+        yield from asyncio.sleep_ms(1000)
+        return bool(self.camera.init())
+
+    def acquire(self):
+        """ Coroutine, returns False if the camera failed to start """
+        while self._starting:
+            # Woken when that start-up succeeds or fails
+            yield from self._starting.wait()
+
+        if self.warm:
+            self.warm_hits += 1
+        else:
+            starting = self._starting = Event()
+            try:
+                if not (yield from self._init()):
+                    return False
+                self.inits += 1
+                # wait for sensor to start and focus before capturing image
+                yield from asyncio.sleep_ms(self.warmup_ms)
+                self.warm = True
+            finally:
+                self._starting = None
+                starting.set()
+
+        self.users += 1
+        self._last = ticks_ms()
+        return True
+
+    def release(self):
+        self.users -= 1
+        self._last = ticks_ms()
+
+    def _idle(self):
+        return self.warm and not self.users and not self._starting and \
+            ticks_diff(ticks_ms(), self._last) >= self.idle_ms
+
+    def arun(self):
+        # Coroutine turning the sensor off after the idle timeout
+        while True:
+            if self._idle():
+                self.warm = False
+                self.camera.deinit()
+                if self.on_deinit:
+                    self.on_deinit()
+            yield from asyncio.sleep_ms(self.poll_ms)
+
+    def status(self):
+        return {
+            'warm': self.warm,
+            'users': self.users,
+            'inits': self.inits,
+            'warm_hits': self.warm_hits
+        }
@@ -0,0 +1,124 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ticks import ticks_ms, ticks_diff, ticks_add
+
+
+class CameraWatchdog():
+    """
+    Wraps camera.capture() to track the success rate and latency of the
+    captures. After `fail_limit` failures in a row the camera is
+    recovering: captures stop, and step() reinitialises it, waiting
+    `backoff_ms` before the first attempt. The wait doubles, up to
+    `max_backoff_ms`, after each failed attempt and each recovery, and only
+    goes back to `backoff_ms` once a capture succeeds, so a sensor that
+    initialises but never delivers is not reinitialised every second.
+    Clients should not wait for frames meanwhile, retry_after() tells them
+    when to come back.
+
+    Give capture to the FrameHub and the watchdog as its `watchdog`, the
+    producer then calls step() between captures.
+    """
+
+    def __init__(self, camera, fail_limit=5, backoff_ms=500, max_backoff_ms=30000,
+                 on_reinit=None):
+        self.camera = camera
+        self.fail_limit = fail_limit
+        self.backoff_ms = backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        # Called after a successful reinit, e.g. to program the settings again
+        self.on_reinit = on_reinit
+
+        self.recovering = False
+        self._backoff = backoff_ms
+        self._retry_at = 0
+        self._failed = 0        # failures in a row
+
+        self.captures = 0
+        self.failures = 0
+        self.success_rate = 100.0   # percent, moving average
+        self.latency_ms = 0.0       # moving average of the successful captures
+        self.recoveries = 0
+        self.reinits = 0
+        self.reinit_failures = 0
+        self.last_failure = None
+
+    def capture(self):
+        start = ticks_ms()
+        buf = self.camera.capture()
+        now = ticks_ms()
+        self.captures += 1
+        if type(buf) is bytes and buf:
+            self._failed = 0
+            self._backoff = self.backoff_ms
+            self.success_rate += (100 - self.success_rate) / 8
+            self.latency_ms += (ticks_diff(now, start) - self.latency_ms) / 8
+            return buf
+
+        self.failures += 1
+        self._failed += 1
+        self.success_rate -= self.success_rate / 8
+        self.last_failure = now
+        if self._failed >= self.fail_limit:
+            self.recovering = True
+            self.recoveries += 1
+            self._schedule(now)
+        return buf
+
+    def _schedule(self, now):
+        self._retry_at = ticks_add(now, self._backoff)
+        self._backoff = min(self._backoff * 2, self.max_backoff_ms)
+
+    def step(self):
+        if not self.recovering or ticks_diff(ticks_ms(), self._retry_at) < 0:
+            return
+        try:
+            self.camera.deinit()
+        except Exception:
+            pass
+        if self.camera.init():
+            self.reinits += 1
+            self.recovering = False
+            self._failed = 0
+            if self.on_reinit:
+                self.on_reinit()
+        else:
+            self.reinit_failures += 1
+            self._schedule(ticks_ms())
+
+    def reset(self):
+        # The camera was turned off and on again by its owner, the backoff
+        # is kept until a capture succeeds
+        self.recovering = False
+        self._failed = 0
+
+    def retry_after(self):
+        """ Seconds until the next reinit attempt, 0 when capturing """
+        if not self.recovering:
+            return 0
+        wait = ticks_diff(self._retry_at, ticks_ms())
+        return max(1, (wait + 999) // 1000)
+
+    def status(self):
+        return {
+            'recovering': self.recovering,
+            'retry_after': self.retry_after(),
+            'captures': self.captures,
+            'failures': self.failures,
+            'success_rate': round(self.success_rate),
+            'latency_ms': round(self.latency_ms),
+            'recoveries': self.recoveries,
+            'reinits': self.reinits,
+            'reinit_failures': self.reinit_failures
+        }
@@ -0,0 +1,321 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ticks import ticks_ms, ticks_diff, sleep_ms
+
+try:
+    from _thread import allocate_lock
+except ImportError:
+    allocate_lock = None
+
+try:
+    from os import urandom
+except ImportError:
+    from uos import urandom
+
+
+class Frame():
+
+    def __init__(self, seq, ts, buf):
+        self.seq = seq      # increases by one for every published frame
+        self.ts = ts        # ticks_ms() at capture time
+        self.buf = buf
+        self.users = 0      # consumers still sending it, see FrameHub.release()
+
+
+class FrameHub():
+    """
+    Single capture producer shared by every stream and snapshot handler.
+
+    The producer only captures while someone asked for a frame within the
+    last `idle_ms`, and every reader gets the same published `Frame`, so
+    the sensor cost does not depend on the number of viewers.
+
+    Capture runs ahead of the network: while consumers send their frames
+    the producer captures the next one into another buffer. `depth` bounds
+    the frame buffers the producer keeps ahead of the consumers, the
+    newest frame still being sent, a published one nobody took yet and the
+    one being captured: 1 captures and sends in turn, 2 is double
+    buffering and from 3 on the producer keeps replacing an untaken frame
+    with a newer one (latest frame wins). Frames held by slower consumers
+    do not hold the producer back, each of them only keeps the one it is
+    sending. Frames returned by get() and aget() must be given back with
+    release(), see Viewer for streams.
+
+    With a CameraWatchdog, the producer lets it recover the camera and
+    consumers stop waiting for frames while it does.
+    """
+
+    def __init__(self, capture, depth=2, idle_ms=2000, poll_ms=5, retry_ms=100,
+                 watchdog=None):
+        self._capture = capture
+        self._frame = None
+        self._demand = None
+        self._running = False
+        self._newest = None # newest frame handed out
+        self._taken = 0     # and its seq
+        self._lock = allocate_lock() if allocate_lock else None
+        # Wakes the aget() consumers, set up by arun()
+        self._published = None
+        # Tells frames of this boot apart from those of a previous one,
+        # random as ticks_ms() is about the same at every boot
+        self.epoch = int.from_bytes(urandom(4), 'big') & 0x3fffffff
+
+        self.idle_ms = idle_ms
+        self.poll_ms = poll_ms
+        self.retry_ms = retry_ms
+
+        self.depth = max(depth, 1)
+        self.captures = 0
+        self.failures = 0
+        self.skipped = 0    # frames replaced before anyone took them
+        self.viewers = []
+        # Called by the producer at every step, the camera is idle meanwhile
+        self.hooks = []
+        self.watchdog = watchdog
+        if watchdog:
+            self.hooks.append(watchdog.step)
+
+    # Producer
+
+    def _has_demand(self):
+        return self._demand is not None and \
+            ticks_diff(ticks_ms(), self._demand) < self.idle_ms
+
+    def capture(self):
+        buf = self._capture()
+        self.captures += 1
+        if type(buf) is not bytes or not buf:
+            self.failures += 1
+            return None
+        last = self._frame
+        if last and last.seq > self._taken:
+            self.skipped += 1
+        seq = last.seq + 1 if last else 1
+        # Publishing is a single reference assignment, readers never lock
+        self._frame = Frame(seq, ticks_ms(), buf)
+        self._notify()
+        return self._frame
+
+    def _buffers(self):
+        n = 1 if self._newest and self._newest.users else 0
+        frame = self._frame
+        if frame and frame.seq > self._taken:
+            n += 1
+        return n
+
+    def _step(self):
+        # Returns how long the producer should sleep before the next step
+        for hook in self.hooks:
+            hook()
+        if not self._has_demand() or self._buffers() >= self.depth:
+            return self.poll_ms
+        if self.watchdog and self.watchdog.recovering:
+            return self.retry_ms
+        if self.capture() is None:
+            return self.retry_ms
+        return 0
+
+    def _run(self):
+        while self._running:
+            delay = self._step()
+            if delay:
+                sleep_ms(delay)
+
+    def start(self):
+        if not self._running:
+            from _thread import start_new_thread
+            self._running = True
+            start_new_thread(self._run, ())
+
+    def stop(self):
+        self._running = False
+
+    def arun(self):
+        # Coroutine producer for uasyncio based servers (picoweb), its
+        # consumers wait for the next frame instead of polling for it
+        import uasyncio as asyncio
+        from uasyncio.synchro import Event
+        self._published = Event()
+        self._running = True
+        try:
+            while self._running:
+                delay = self._step()
+                if self._recovering():
+                    # Consumers give up waiting while the camera recovers
+                    self._notify()
+                yield from asyncio.sleep_ms(delay)
+        finally:
+            self._published = None
+
+    def _notify(self):
+        published = self._published
+        if published:
+            # Wakes the current waiters only
+            published.set()
+            published.clear()
+
+    # Consumers
+
+    def latest(self):
+        return self._frame
+
+    def _take(self, frame):
+        if self._lock:
+            self._lock.acquire()
+        frame.users += 1
+        if frame.seq > self._taken:
+            self._newest = frame
+            self._taken = frame.seq
+        if self._lock:
+            self._lock.release()
+        return frame
+
+    def release(self, frame):
+        """ Gives back a frame from get() or aget() once it is sent """
+        if frame is None:
+            return
+        if self._lock:
+            self._lock.acquire()
+        frame.users -= 1
+        if self._lock:
+            self._lock.release()
+
+    def _recovering(self):
+        return self.watchdog is not None and self.watchdog.recovering
+
+    def _wanted(self, after):
+        # A frame left over from an idle period is stale, wait for a new one
+        frame = self._frame
+        if not self._has_demand() and frame:
+            after = max(after, frame.seq)
+            # Nobody will take it, its buffer is free for the next capture
+            self._taken = max(self._taken, frame.seq)
+        self._demand = ticks_ms()
+        return after
+
+    def get(self, after=0, timeout_ms=5000):
+        """ Blocks until a frame newer than `after` is published """
+        after = self._wanted(after)
+        start = ticks_ms()
+        while True:
+            frame = self._frame
+            if frame and frame.seq > after:
+                return self._take(frame)
+            if ticks_diff(ticks_ms(), start) >= timeout_ms or self._recovering():
+                return None
+            self._demand = ticks_ms()
+            sleep_ms(self.poll_ms)
+
+    def aget(self, after=0, timeout_ms=5000):
+        """ Coroutine version of get() """
+        import uasyncio as asyncio
+        after = self._wanted(after)
+        start = ticks_ms()
+        while True:
+            frame = self._frame
+            if frame and frame.seq > after:
+                return self._take(frame)
+            left = timeout_ms - ticks_diff(ticks_ms(), start)
+            if left <= 0 or self._recovering():
+                return None
+            self._demand = ticks_ms()
+            published = self._published
+            if published is None:
+                # Producer in its own thread
+                yield from asyncio.sleep_ms(self.poll_ms)
+                continue
+            try:
+                # Woken by the next capture, waking up in time to keep
+                # the demand alive
+                yield from asyncio.wait_for_ms(published.wait(),
+                                               min(left, self.idle_ms // 2))
+            except asyncio.TimeoutError:
+                pass
+
+
+class Viewer():
+    """
+    Per client end of a stream. The client's send queue is the hub's
+    published frame: at most one frame is pending for it and a newer one
+    replaces it while the client is still sending, so a slow client skips
+    frames (counted in `dropped`) instead of delaying anyone else or
+    buffering more. Frames published after done(), while the caller waits
+    on purpose (an fps cap), are not counted. Viewers are listed in
+    hub.viewers until close().
+    """
+
+    def __init__(self, hub, name):
+        self.hub = hub
+        self.name = name
+        self.seq = 0
+        self.sent = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.send_ms = 0    # time spent writing the frames it sent
+        self.started = ticks_ms()
+        self._frame = None
+        self._since = 0
+        self._ready = 0     # newest published seq when the last send ended
+        hub.viewers.append(self)
+
+    def _got(self, frame):
+        if frame is not None:
+            # Only the frames replaced while it was still sending
+            if self.seq and self._ready > self.seq:
+                self.dropped += min(frame.seq, self._ready) - self.seq - 1
+            self.seq = frame.seq
+            self._frame = frame
+            self._since = ticks_ms()
+        return frame
+
+    def get(self, timeout_ms=5000):
+        """ Next frame to send, call done() once it is written """
+        return self._got(self.hub.get(self.seq, timeout_ms))
+
+    def aget(self, timeout_ms=5000):
+        """ Coroutine version of get() """
+        frame = yield from self.hub.aget(self.seq, timeout_ms)
+        return self._got(frame)
+
+    def _release(self):
+        frame = self._frame
+        self._frame = None
+        self.hub.release(frame)
+        return frame is not None
+
+    def done(self):
+        frame = self._frame
+        if self._release():
+            latest = self.hub.latest()
+            self._ready = latest.seq if latest else 0
+            self.sent += 1
+            self.bytes += len(frame.buf)
+            self.send_ms += ticks_diff(ticks_ms(), self._since)
+
+    def close(self):
+        # A frame whose send failed goes back without counting as sent
+        self._release()
+        if self in self.hub.viewers:
+            self.hub.viewers.remove(self)
+
+    def stats(self):
+        elapsed = ticks_diff(ticks_ms(), self.started)
+        return {
+            'name': self.name,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'bytes': self.bytes,
+            'fps': self.sent * 1000 // elapsed if elapsed > 0 else 0
+        }
@@ -1,4 +1,5 @@
 import uerrno
+import utime as time
 import uselect as select
 import usocket as _socket
 from uasyncio.core import *
@@ -7,6 +8,9 @@ from uasyncio.core import *
 DEBUG = 0
 log = None
 
+# Not available on every port, StreamReader scans for separators itself then
+_bytearray_find = getattr(bytearray, "find", None)
+
 def set_debug(val):
     global DEBUG, log
     DEBUG = val
@@ -22,45 +26,50 @@ class PollEventLoop(EventLoop):
         self.poller = select.poll()
         self.objmap = {}
 
+    def _arm(self, sock, ev, cb):
+        # Sockets stay registered between waits (one-shot polling only
+        # disables them), so waiting again just sets the event mask
+        if id(sock) in self.objmap:
+            try:
+                self.poller.modify(sock, ev)
+            except OSError:
+                # A new socket with the id of one closed while registered
+                self.poller.register(sock, ev)
+        else:
+            self.poller.register(sock, ev)
+        self.objmap[id(sock)] = cb
+
+    def _disarm(self, sock):
+        try:
+            self.poller.unregister(sock)
+        except OSError as e:
+            # StreamWriter.awrite() first tries to write to a socket,
+            # and if that succeeds, yield IOWrite may never be called
+            # for that socket, and it will never be added to poller. So,
+            # ignore such error.
+            if e.args[0] != uerrno.ENOENT:
+                raise
+        self.objmap.pop(id(sock), None)
+
     def add_reader(self, sock, cb, *args):
         if DEBUG and __debug__:
             log.debug("add_reader%s", (sock, cb, args))
-        if args:
-            self.poller.register(sock, select.POLLIN)
-            self.objmap[id(sock)] = (cb, args)
-        else:
-            self.poller.register(sock, select.POLLIN)
-            self.objmap[id(sock)] = cb
+        self._arm(sock, select.POLLIN, (cb, args) if args else cb)
 
     def remove_reader(self, sock):
         if DEBUG and __debug__:
             log.debug("remove_reader(%s)", sock)
-        self.poller.unregister(sock)
-        del self.objmap[id(sock)]
+        self._disarm(sock)
 
     def add_writer(self, sock, cb, *args):
         if DEBUG and __debug__:
             log.debug("add_writer%s", (sock, cb, args))
-        if args:
-            self.poller.register(sock, select.POLLOUT)
-            self.objmap[id(sock)] = (cb, args)
-        else:
-            self.poller.register(sock, select.POLLOUT)
-            self.objmap[id(sock)] = cb
+        self._arm(sock, select.POLLOUT, (cb, args) if args else cb)
 
     def remove_writer(self, sock):
         if DEBUG and __debug__:
             log.debug("remove_writer(%s)", sock)
-        try:
-            self.poller.unregister(sock)
-            self.objmap.pop(id(sock), None)
-        except OSError as e:
-            # StreamWriter.awrite() first tries to write to a socket,
-            # and if that succeeds, yield IOWrite may never be called
-            # for that socket, and it will never be added to poller. So,
-            # ignore such error.
-            if e.args[0] != uerrno.ENOENT:
-                raise
+        self._disarm(sock)
 
     def wait(self, delay):
         if DEBUG and __debug__:
@@ -72,6 +81,8 @@ class PollEventLoop(EventLoop):
         # https://github.com/micropython/micropython/issues/2716 fixed.
         if res:
             for sock, ev in res:
+                if self.stats:
+                    self.stats.io_events += 1
                 cb = self.objmap[id(sock)]
                 if ev & (select.POLLHUP | select.POLLERR):
                     # These events are returned even if not requested, and
@@ -91,15 +102,82 @@ class PollEventLoop(EventLoop):
 
 class StreamReader:
 
-    def __init__(self, polls, ios=None):
+    def __init__(self, polls, ios=None, bufsize=512):
         if ios is None:
             ios = polls
         self.polls = polls
         self.ios = ios
+        # Read-ahead buffer, the unread data is buf[start:end]. Lines are
+        # parsed in place and bulk reads go straight to the caller's buffer
+        self.buf = bytearray(bufsize)
+        self.mv = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        # Yielded on every wait, the loop only reads its argument
+        self.ioread = IORead(polls)
+
+    def _readinto(self, buf):
+        while True:
+            yield self.ioread
+            res = self.ios.readinto(buf)
+            if res is not None:
+                break
+            # This should not happen for real sockets, but can easily
+            # happen for stream wrappers (ssl, websockets, etc.)
+            #log.warn("Empty read")
+        if not res:
+            yield IOReadDone(self.polls)
+        return res
+
+    def _compact(self):
+        # Moves the unread data to the front, in pieces that don't overlap
+        start = self.start
+        n = self.end - start
+        i = 0
+        while i < n:
+            m = min(start, n - i)
+            self.mv[i:i + m] = self.mv[start + i:start + i + m]
+            i += m
+        self.start = 0
+        self.end = n
+
+    def _fill(self):
+        # Reads more into the buffer, returns how many bytes (0 at end of
+        # stream, or when the buffer is full)
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start and self.end == len(self.buf):
+            self._compact()
+        if self.end == len(self.buf):
+            return 0
+        res = yield from self._readinto(self.mv[self.end:])
+        self.end += res
+        return res
+
+    def _find(self, sep, pos):
+        # Offset just past the first `sep` at or after `pos`, or -1
+        buf = self.buf
+        n = len(sep)
+        if _bytearray_find:
+            i = _bytearray_find(buf, sep, pos, self.end)
+            return i + n if i >= 0 else -1
+        last = sep[-1]
+        for i in range(pos + n - 1, self.end):
+            if buf[i] == last and (n == 1 or buf[i - n + 1:i + 1] == sep):
+                return i + 1
+        return -1
+
+    def _take(self, end):
+        res = self.mv[self.start:end]
+        self.start = end
+        return res
 
     def read(self, n=-1):
+        if self.start < self.end:
+            end = self.end if n < 0 else min(self.end, self.start + n)
+            return bytes(self._take(end))
         while True:
-            yield IORead(self.polls)
+            yield self.ioread
             res = self.ios.read(n)
             if res is not None:
                 break
@@ -110,33 +188,52 @@ class StreamReader:
             yield IOReadDone(self.polls)
         return res
 
+    def readinto(self, buf):
+        # Returns how many bytes were read into buf, 0 at end of stream
+        avail = self.end - self.start
+        if avail:
+            n = min(avail, len(buf))
+            buf[:n] = self.mv[self.start:self.start + n]
+            self.start += n
+            return n
+        return (yield from self._readinto(buf))
+
     def readexactly(self, n):
-        buf = b""
-        while n:
-            yield IORead(self.polls)
-            res = self.ios.read(n)
-            assert res is not None
+        # Returns a bytearray, shorter than n only at end of stream
+        buf = bytearray(n)
+        mv = memoryview(buf)
+        got = 0
+        while got < n:
+            res = yield from self.readinto(mv[got:])
             if not res:
-                yield IOReadDone(self.polls)
-                break
-            buf += res
-            n -= len(res)
+                return buf[:got]
+            got += res
         return buf
 
+    def readuntil(self, sep=b"\n"):
+        # Returns a memoryview of the data up to and including sep, only
+        # valid until the next read. It is cut short at end of stream or
+        # when the buffer is full
+        scanned = 0
+        while True:
+            i = self._find(sep, self.start + scanned)
+            if i >= 0:
+                return self._take(i)
+            scanned = max(self.end - self.start - len(sep) + 1, 0)
+            if not (yield from self._fill()):
+                return self._take(self.end)
+
     def readline(self):
+        # Returns whole lines, joining the pieces readuntil() cuts those
+        # longer than the buffer into
         if DEBUG and __debug__:
             log.debug("StreamReader.readline()")
-        buf = b""
-        while True:
-            yield IORead(self.polls)
-            res = self.ios.readline()
-            assert res is not None
-            if not res:
-                yield IOReadDone(self.polls)
-                break
-            buf += res
-            if buf[-1] == 0x0a:
+        buf = bytes((yield from self.readuntil(b"\n")))
+        while buf and buf[-1] != 0x0a:
+            part = yield from self.readuntil(b"\n")
+            if not part:
                 break
+            buf += part
         if DEBUG and __debug__:
             log.debug("StreamReader.readline(): %s", buf)
         return buf
@@ -154,6 +251,7 @@ class StreamWriter:
     def __init__(self, s, extra):
         self.s = s
         self.extra = extra
+        self.iowrite = IOWrite(s)
 
     def awrite(self, buf, off=0, sz=-1):
         # This method is called awrite (async write) to not proliferate
@@ -179,7 +277,7 @@ class StreamWriter:
             assert res < sz
             off += res
             sz -= res
-            yield IOWrite(self.s)
+            yield self.iowrite
             #assert s2.fileno() == self.s.fileno()
             if DEBUG and __debug__:
                 log.debug("StreamWriter.awrite(): can write more")
@@ -229,7 +327,53 @@ def open_connection(host, port, ssl=False):
     return StreamReader(s), StreamWriter(s, {})
 
 
-def start_server(client_coro, host, port, backlog=10):
+# Sent to the connections beyond start_server()'s max_clients
+BUSY_RESPONSE = b"HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\n" \
+                b"Content-Length: 0\r\nConnection: close\r\n\r\n"
+
+
+class ServerStats:
+    # Counters of a start_server(): connections accepted, rejected beyond
+    # max_clients and failed accept() calls, the clients served now and at
+    # most, and how many connections a single wake-up accepted
+
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = 0
+        self.active = 0
+        self.peak = 0
+        self.wakeups = 0
+        self.batch_max = 0
+        self._since = time.ticks_ms()
+        self._seen = 0
+
+    def snapshot(self):
+        # The accept rate covers the time since the previous snapshot
+        now = time.ticks_ms()
+        ms = time.ticks_diff(now, self._since)
+        seen = self.accepted + self.rejected
+        rate = (seen - self._seen) * 1000 // ms if ms > 0 else 0
+        self._since = now
+        self._seen = seen
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "active": self.active,
+            "peak": self.peak,
+            "wakeups": self.wakeups,
+            "batch_max": self.batch_max,
+            "accepts_per_s": rate,
+        }
+
+
+def start_server(client_coro, host, port, backlog=10, max_clients=0,
+                 stats=None, busy=BUSY_RESPONSE):
+    # Every wake-up accepts all the pending connections. Beyond max_clients
+    # (0 for no limit) connections get `busy` and are closed at once, no
+    # reader, writer or coroutine is allocated for them. Clients run as
+    # Tasks, counted in `stats` (a ServerStats) until they end.
     if DEBUG and __debug__:
         log.debug("start_server(%s, %s)", host, port)
     ai = _socket.getaddrinfo(host, port, 0, _socket.SOCK_STREAM)
@@ -240,18 +384,61 @@ def start_server(client_coro, host, port, backlog=10):
     s.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEADDR, 1)
     s.bind(ai[-1])
     s.listen(backlog)
-    while True:
-        if DEBUG and __debug__:
-            log.debug("start_server: Before accept")
-        yield IORead(s)
-        if DEBUG and __debug__:
-            log.debug("start_server: After iowait")
-        s2, client_addr = s.accept()
-        s2.setblocking(False)
-        if DEBUG and __debug__:
-            log.debug("start_server: After accept: %s", s2)
-        extra = {"peername": client_addr}
-        yield client_coro(StreamReader(s2), StreamWriter(s2, extra))
+    loop = get_event_loop()
+    if stats is None:
+        stats = ServerStats()
+
+    def client_done(task):
+        stats.active -= 1
+        if task._exc and not task.cancelled():
+            print("Client exception: %r" % task._exc)
+
+    ioread = IORead(s)
+    try:
+        while True:
+            if DEBUG and __debug__:
+                log.debug("start_server: Before accept")
+            yield ioread
+            if DEBUG and __debug__:
+                log.debug("start_server: After iowait")
+            stats.wakeups += 1
+            n = 0
+            while True:
+                try:
+                    s2, client_addr = s.accept()
+                except OSError as e:
+                    if e.args[0] != uerrno.EAGAIN:
+                        # Out of sockets or memory, give the clients time to end
+                        stats.errors += 1
+                        yield 100
+                    break
+                n += 1
+                s2.setblocking(False)
+                if max_clients and stats.active >= max_clients:
+                    stats.rejected += 1
+                    if busy:
+                        try:
+                            s2.write(busy)
+                        except OSError:
+                            pass
+                    s2.close()
+                    continue
+                if DEBUG and __debug__:
+                    log.debug("start_server: After accept: %s", s2)
+                stats.accepted += 1
+                stats.active += 1
+                if stats.active > stats.peak:
+                    stats.peak = stats.active
+                extra = {"peername": client_addr}
+                task = Task(client_coro(StreamReader(s2), StreamWriter(s2, extra)), loop)
+                task.add_done_callback(client_done)
+            if n > stats.batch_max:
+                stats.batch_max = n
+
+    finally:
+        # Cancelled, free the port
+        loop.remove_reader(s)
+        s.close()
 
 
 import uasyncio.core
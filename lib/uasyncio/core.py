@@ -1,6 +1,4 @@
 import utime as time
-import utimeq
-import ucollections
 
 
 type_gen = type((lambda: (yield))())
@@ -24,23 +22,241 @@ class TimeoutError(CancelledError):
     pass
 
 
+class RunQueue:
+    # FIFO ring buffer doubling its capacity when full, instead of raising
+
+    def __init__(self, size=16):
+        self.buf = [None] * size
+        self.head = 0
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, v):
+        size = len(self.buf)
+        if self.n == size:
+            self.buf = self.buf[self.head:] + self.buf[:self.head] + [None] * size
+            self.head = 0
+            size += size
+        self.buf[(self.head + self.n) % size] = v
+        self.n += 1
+
+    def popleft(self):
+        if not self.n:
+            raise IndexError("empty")
+        v = self.buf[self.head]
+        self.buf[self.head] = None
+        self.head = (self.head + 1) % len(self.buf)
+        self.n -= 1
+        return v
+
+
+class TimerQueue:
+    # Binary heap of [time, seq, callback, args] in ticks order, growing
+    # as needed. push() returns the entry, which cancel() marks dead: it
+    # is skipped when it reaches the top, and the heap is rebuilt without
+    # dead entries once they are the majority.
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.dead = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.dead
+
+    def _less(self, a, b):
+        d = time.ticks_diff(a[0], b[0])
+        return d < 0 or d == 0 and a[1] < b[1]
+
+    def _up(self, i):
+        heap = self.heap
+        entry = heap[i]
+        while i:
+            parent = (i - 1) >> 1
+            if not self._less(entry, heap[parent]):
+                break
+            heap[i] = heap[parent]
+            i = parent
+        heap[i] = entry
+
+    def _down(self, i):
+        heap = self.heap
+        n = len(heap)
+        entry = heap[i]
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and self._less(heap[child + 1], heap[child]):
+                child += 1
+            if not self._less(heap[child], entry):
+                break
+            heap[i] = heap[child]
+            i = child
+        heap[i] = entry
+
+    def _popentry(self):
+        heap = self.heap
+        entry = heap[0]
+        last = heap.pop()
+        if heap:
+            heap[0] = last
+            self._down(0)
+        return entry
+
+    def _skipdead(self):
+        while self.heap and self.heap[0][2] is None:
+            self._popentry()
+            self.dead -= 1
+
+    def push(self, t, callback, args):
+        self.seq = (self.seq + 1) & 0x3fffffff
+        entry = [t, self.seq, callback, args]
+        self.heap.append(entry)
+        self._up(len(self.heap) - 1)
+        return entry
+
+    def peektime(self):
+        self._skipdead()
+        return self.heap[0][0]
+
+    def pop(self, res):
+        self._skipdead()
+        entry = self._popentry()
+        res[0] = entry[0]
+        res[1] = entry[2]
+        res[2] = entry[3]
+        # Done, a late cancel() is a no-op
+        entry[2] = None
+
+    def cancel(self, entry):
+        if entry is not None and entry[2] is not None:
+            entry[2] = None
+            entry[3] = None
+            self.dead += 1
+            self.cancelled += 1
+            if self.dead > len(self.heap) >> 1:
+                self.heap = [e for e in self.heap if e[2] is not None]
+                self.dead = 0
+                for i in range((len(self.heap) >> 1) - 1, -1, -1):
+                    self._down(i)
+
+
+class LoopStats:
+    # Counters kept by run_forever() once enable_stats() was called: the
+    # time of each loop iteration (without waiting), how late waitq
+    # entries ran, the time blocked in wait() and the run time of every
+    # task (top-level coroutine), dropped when it ends.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.ticks_ms()
+        self.iterations = 0
+        self.busy_us = 0
+        self.iter_max_us = 0
+        self.wait_us = 0
+        self.waits = 0
+        self.io_events = 0
+        self.timers = 0
+        self.lag_ms = 0
+        self.lag_max_ms = 0
+        self.tasks = {}
+
+    def iteration(self, us):
+        self.iterations += 1
+        self.busy_us += us
+        if us > self.iter_max_us:
+            self.iter_max_us = us
+
+    def lag(self, ms):
+        self.timers += 1
+        self.lag_ms += ms
+        if ms > self.lag_max_ms:
+            self.lag_max_ms = ms
+
+    def waited(self, us):
+        self.waits += 1
+        self.wait_us += us
+
+    def ran(self, task, t0, done=False):
+        us = time.ticks_diff(time.ticks_us(), t0)
+        if done:
+            self.tasks.pop(task, None)
+            return
+        entry = self.tasks.get(task)
+        if entry is None:
+            self.tasks[task] = [us, 1, us]
+        else:
+            entry[0] += us
+            entry[1] += 1
+            if us > entry[2]:
+                entry[2] = us
+
+    def snapshot(self, top=8):
+        # Plain dict (JSON ready), tasks with the most run time first
+        tasks = sorted(self.tasks.items(), key=lambda item: -item[1][0])[:top]
+        return {
+            'uptime_ms': time.ticks_diff(time.ticks_ms(), self.since),
+            'iterations': self.iterations,
+            'iter_avg_us': self.busy_us // self.iterations if self.iterations else 0,
+            'iter_max_us': self.iter_max_us,
+            'busy_ms': self.busy_us // 1000,
+            'wait_ms': self.wait_us // 1000,
+            'waits': self.waits,
+            'io_events': self.io_events,
+            'lag_avg_ms': self.lag_ms // self.timers if self.timers else 0,
+            'lag_max_ms': self.lag_max_ms,
+            'task_count': len(self.tasks),
+            'tasks': [{'name': _task_name(task), 'run_ms': entry[0] // 1000,
+                       'steps': entry[1], 'max_us': entry[2]}
+                      for task, entry in tasks]
+        }
+
+
+def _task_name(task):
+    name = getattr(task, '__name__', None)
+    if name:
+        return name
+    # MicroPython: <generator object 'name' at 3ffe1234>
+    name = repr(task)
+    i = name.find("'")
+    if i >= 0:
+        return name[i + 1:name.find("'", i + 1)]
+    return name
+
+
 class EventLoop:
 
     def __init__(self, runq_len=16, waitq_len=16):
-        self.runq = ucollections.deque((), runq_len, True)
-        self.waitq = utimeq.utimeq(waitq_len)
+        # Both queues grow with the number of tasks, runq_len is only the
+        # initial size and waitq_len is kept for compatibility
+        self.runq = RunQueue(runq_len)
+        self.waitq = TimerQueue()
         # Current task being run. Task is a top-level coroutine scheduled
         # in the event loop (sub-coroutines executed transparently by
         # yield from/await, event loop "doesn't see" them).
         self.cur_task = None
+        self.stats = None
+        # Task objects of the coroutines started by create_task()
+        self.tasks = {}
+
+    def enable_stats(self, on=True):
+        self.stats = LoopStats() if on else None
+
+    def stats_snapshot(self, top=8):
+        # None unless enable_stats() was called
+        return self.stats.snapshot(top) if self.stats else None
 
     def time(self):
         return time.ticks_ms()
 
     def create_task(self, coro):
-        # CPython 3.4.2
-        self.call_later_ms(0, coro)
-        # CPython asyncio incompatibility: we don't return Task object
+        return Task(coro, self)
 
     def call_soon(self, callback, *args):
         if __debug__ and DEBUG:
@@ -49,18 +265,24 @@ class EventLoop:
         if not isinstance(callback, type_gen):
             self.runq.append(args)
 
+    # The call_later*() and call_at_() return a handle for cancel_call()
+
     def call_later(self, delay, callback, *args):
-        self.call_at_(time.ticks_add(self.time(), int(delay * 1000)), callback, args)
+        return self.call_at_(time.ticks_add(self.time(), int(delay * 1000)), callback, args)
 
     def call_later_ms(self, delay, callback, *args):
         if not delay:
             return self.call_soon(callback, *args)
-        self.call_at_(time.ticks_add(self.time(), delay), callback, args)
+        return self.call_at_(time.ticks_add(self.time(), delay), callback, args)
 
     def call_at_(self, time, callback, args=()):
         if __debug__ and DEBUG:
             log.debug("Scheduling in waitq: %s", (time, callback, args))
-        self.waitq.push(time, callback, args)
+        return self.waitq.push(time, callback, args)
+
+    def cancel_call(self, handle):
+        # Drops a pending call_later*() or call_at_(), no-op once it ran
+        self.waitq.cancel(handle)
 
     def wait(self, delay):
         # Default wait implementation, to be overriden in subclasses
@@ -72,6 +294,9 @@ class EventLoop:
     def run_forever(self):
         cur_task = [0, 0, 0]
         while True:
+            stats = self.stats
+            if stats:
+                t_iter = time.ticks_us()
             # Expire entries in waitq and move them to runq
             tnow = self.time()
             while self.waitq:
@@ -79,6 +304,8 @@ class EventLoop:
                 delay = time.ticks_diff(t, tnow)
                 if delay > 0:
                     break
+                if stats:
+                    stats.lag(-delay)
                 self.waitq.pop(cur_task)
                 if __debug__ and DEBUG:
                     log.debug("Moving from waitq to runq: %s", cur_task[1])
@@ -104,11 +331,15 @@ class EventLoop:
                     log.info("Next coroutine to run: %s", (cb, args))
                 self.cur_task = cb
                 delay = 0
+                if stats:
+                    t_run = time.ticks_us()
                 try:
                     if args is ():
                         ret = next(cb)
                     else:
                         ret = cb.send(*args)
+                    if stats:
+                        stats.ran(cb, t_run)
                     if __debug__ and DEBUG:
                         log.info("Coroutine %s yield result: %s", cb, ret)
                     if isinstance(ret, SysCall1):
@@ -133,24 +364,47 @@ class EventLoop:
                             assert False, "Unknown syscall yielded: %r (of type %r)" % (ret, type(ret))
                     elif isinstance(ret, type_gen):
                         self.call_soon(ret)
+                    elif ret is False:
+                        # Don't reschedule, parked until _wake() or cancel()
+                        # (tested before int, which False is an instance of)
+                        cb.pend_throw(False)
+                        continue
                     elif isinstance(ret, int):
                         # Delay
                         delay = ret
                     elif ret is None:
                         # Just reschedule
                         pass
-                    elif ret is False:
-                        # Don't reschedule
-                        continue
                     else:
                         assert False, "Unsupported coroutine yield value: %r (of type %r)" % (ret, type(ret))
                 except StopIteration as e:
+                    if stats:
+                        stats.ran(cb, t_run, True)
                     if __debug__ and DEBUG:
                         log.debug("Coroutine finished: %s", cb)
+                    if self.tasks:
+                        task = self.tasks.pop(cb, None)
+                        if task:
+                            task._finish(e.args[0] if e.args else None, None)
                     continue
                 except CancelledError as e:
+                    if stats:
+                        stats.ran(cb, t_run, True)
                     if __debug__ and DEBUG:
                         log.debug("Coroutine cancelled: %s", cb)
+                    if self.tasks:
+                        task = self.tasks.pop(cb, None)
+                        if task:
+                            task._finish(None, e)
+                    continue
+                except Exception as e:
+                    # Kept by its Task, a coroutine without one stops the loop
+                    task = self.tasks.pop(cb, None)
+                    if task is None:
+                        raise
+                    if stats:
+                        stats.ran(cb, t_run, True)
+                    task._finish(None, e)
                     continue
                 # Currently all syscalls don't return anything, so we don't
                 # need to feed anything to the next invocation of coroutine.
@@ -170,7 +424,13 @@ class EventLoop:
                     delay = time.ticks_diff(t, tnow)
                     if delay < 0:
                         delay = 0
-            self.wait(delay)
+            if stats:
+                t_wait = time.ticks_us()
+                stats.iteration(time.ticks_diff(t_wait, t_iter))
+                self.wait(delay)
+                stats.waited(time.ticks_diff(time.ticks_us(), t_wait))
+            else:
+                self.wait(delay)
 
     def run_until_complete(self, coro):
         def _run_and_stop():
@@ -263,18 +523,153 @@ def cancel(coro):
         _event_loop.call_soon(coro)
 
 
+def _park(waiters):
+    # Parks the running coroutine in `waiters` until _wake() reschedules it,
+    # it is taken off the list again when cancelled or timed out meanwhile
+    waiter = _event_loop.cur_task
+    waiters.append(waiter)
+    try:
+        yield False
+    except:
+        if waiter in waiters:
+            waiters.remove(waiter)
+        raise
+
+
+def _wake(coro):
+    # Reschedules a coroutine parked by yielding False, unless cancel()
+    # or a timeout already pended an exception and scheduled it
+    prev = coro.pend_throw(None)
+    if prev is False:
+        _event_loop.call_soon(coro)
+    elif prev is not None:
+        coro.pend_throw(prev)
+
+
+class Task:
+    # Handle of a coroutine scheduled by create_task(). join() (or yield
+    # from the task) waits for its result, cancel() throws CancelledError
+    # into it and add_done_callback() functions get the task once it
+    # ended. An exception ending it is kept for join() and result(), and
+    # printed if nobody waits for it.
+
+    def __init__(self, coro, loop=None):
+        if loop is None:
+            loop = get_event_loop()
+        self.coro = coro
+        self._done = False
+        self._result = None
+        self._exc = None
+        self._waiters = []
+        self._callbacks = []
+        loop.tasks[coro] = self
+        loop.call_soon(coro)
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return isinstance(self._exc, CancelledError)
+
+    def result(self):
+        if self._exc:
+            raise self._exc
+        return self._result
+
+    def cancel(self):
+        if self._done:
+            return False
+        try:
+            cancel(self.coro)
+        except TypeError:
+            # Not started yet: it ends as cancelled without running
+            self.coro.close()
+            self._exc = CancelledError()
+        return True
+
+    def add_done_callback(self, fn):
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def join(self):
+        if not self._done:
+            yield from _park(self._waiters)
+        return self.result()
+
+    __iter__ = join
+
+    def _finish(self, result, exc):
+        self._done = True
+        self._result = result
+        if self._exc is None:
+            self._exc = exc
+        if self._exc and not isinstance(self._exc, CancelledError) and \
+           not (self._waiters or self._callbacks):
+            print("Task exception: %r" % self._exc)
+        waiters = self._waiters
+        self._waiters = []
+        for waiter in waiters:
+            _wake(waiter)
+        callbacks = self._callbacks
+        self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+
+def gather(*aws, return_exceptions=False):
+    # Runs coroutines (or waits for Tasks) concurrently and returns their
+    # results in order. Unless return_exceptions, the first exception
+    # cancels the tasks still running and is raised, and cancelling
+    # gather() cancels them all
+    loop = get_event_loop()
+    tasks = [aw if isinstance(aw, Task) else loop.create_task(aw) for aw in aws]
+    waiter = _event_loop.cur_task
+    active = [True]
+
+    def done(task):
+        if active[0]:
+            _wake(waiter)
+
+    for task in tasks:
+        task.add_done_callback(done)
+    try:
+        while True:
+            pending = 0
+            for task in tasks:
+                if not task.done():
+                    pending += 1
+                elif task._exc and not return_exceptions:
+                    raise task._exc
+            if not pending:
+                break
+            yield False
+    except:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        active[0] = False
+    return [task._exc or task._result for task in tasks]
+
+
 class TimeoutObj:
     def __init__(self, coro):
         self.coro = coro
+        self.handle = None
 
 
 def wait_for_ms(coro, timeout):
 
     def waiter(coro, timeout_obj):
-        res = yield from coro
-        if __debug__ and DEBUG:
-            log.debug("waiter: cancelling %s", timeout_obj)
-        timeout_obj.coro = None
+        try:
+            res = yield from coro
+        finally:
+            if __debug__ and DEBUG:
+                log.debug("waiter: cancelling %s", timeout_obj)
+            timeout_obj.coro = None
+            _event_loop.cancel_call(timeout_obj.handle)
         return res
 
     def timeout_func(timeout_obj):
@@ -287,7 +682,7 @@ def wait_for_ms(coro, timeout):
                 _event_loop.call_soon(timeout_obj.coro)
 
     timeout_obj = TimeoutObj(_event_loop.cur_task)
-    _event_loop.call_later_ms(timeout, timeout_func, timeout_obj)
+    timeout_obj.handle = _event_loop.call_later_ms(timeout, timeout_func, timeout_obj)
     return (yield from waiter(coro, timeout_obj))
 
 
@@ -303,13 +698,5 @@ def coroutine(f):
 # for compatibility with CPython asyncio
 #
 
-def ensure_future(coro, loop=_event_loop):
-    _event_loop.call_soon(coro)
-    # CPython asyncio incompatibility: we don't return Task object
-    return coro
-
-
-# CPython asyncio incompatibility: Task is a function, not a class (for efficiency)
-def Task(coro, loop=_event_loop):
-    # Same as async()
-    _event_loop.call_soon(coro)
+def ensure_future(coro, loop=None):
+    return Task(coro, loop)
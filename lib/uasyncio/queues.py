@@ -0,0 +1,74 @@
+from uasyncio import core
+from uasyncio.synchro import _wake_one
+
+
+class QueueEmpty(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Queue:
+    # FIFO between coroutines. get() blocks while it is empty, put() while
+    # `maxsize` items are queued (0 is unbounded). With overwrite, a full
+    # queue drops its oldest item instead, so a producer never blocks and
+    # consumers always get the most recent items: put_nowait() then returns
+    # the item it dropped, for instance to recycle its buffer.
+
+    def __init__(self, maxsize=0, overwrite=False):
+        self.maxsize = maxsize
+        self.overwrite = overwrite
+        self._queue = []
+        self._getters = []
+        self._putters = []
+        self.dropped = 0
+
+    def qsize(self):
+        return len(self._queue)
+
+    def empty(self):
+        return not self._queue
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._queue)
+
+    def get_nowait(self):
+        if not self._queue:
+            raise QueueEmpty()
+        item = self._queue.pop(0)
+        _wake_one(self._putters)
+        return item
+
+    def get(self):
+        while not self._queue:
+            try:
+                yield from core._park(self._getters)
+            except:
+                # Woken but cancelled before running: pass the item on
+                if self._queue:
+                    _wake_one(self._getters)
+                raise
+        return self.get_nowait()
+
+    def put_nowait(self, item):
+        dropped = None
+        if self.full():
+            if not self.overwrite:
+                raise QueueFull()
+            dropped = self._queue.pop(0)
+            self.dropped += 1
+        self._queue.append(item)
+        _wake_one(self._getters)
+        return dropped
+
+    def put(self, item):
+        while self.full() and not self.overwrite:
+            try:
+                yield from core._park(self._putters)
+            except:
+                if not self.full():
+                    _wake_one(self._putters)
+                raise
+        return self.put_nowait(item)
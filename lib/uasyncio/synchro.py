@@ -0,0 +1,68 @@
+from uasyncio import core
+
+
+def _wake_one(waiters):
+    if waiters:
+        core._wake(waiters.pop(0))
+
+
+class Event:
+    # set() reschedules every coroutine blocked in wait(), and later wait()
+    # calls return at once until clear(). set() followed by clear() wakes
+    # the current waiters only.
+
+    def __init__(self):
+        self.state = False
+        self._waiters = []
+
+    def is_set(self):
+        return self.state
+
+    def set(self):
+        self.state = True
+        waiters = self._waiters
+        self._waiters = []
+        for waiter in waiters:
+            core._wake(waiter)
+
+    def clear(self):
+        self.state = False
+
+    def wait(self):
+        if not self.state:
+            yield from core._park(self._waiters)
+        return True
+
+
+class Semaphore:
+    # Counts `value` permits, acquire() blocks while none is left and
+    # release() hands one to the longest waiting coroutine
+
+    def __init__(self, value=1):
+        self.value = value
+        self._waiters = []
+
+    def locked(self):
+        return self.value == 0
+
+    def acquire(self):
+        while self.value == 0:
+            try:
+                yield from core._park(self._waiters)
+            except:
+                # Woken but cancelled before running: pass the permit on
+                if self.value:
+                    _wake_one(self._waiters)
+                raise
+        self.value -= 1
+        return True
+
+    def release(self):
+        self.value += 1
+        _wake_one(self._waiters)
+
+
+class Lock(Semaphore):
+
+    def __init__(self):
+        Semaphore.__init__(self, 1)
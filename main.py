@@ -3,8 +3,6 @@ import webcam
 webcam.run()
 """
 
-import camera
-import machine
 from config import app_config
 from webserver import webcam
 
@@ -6,10 +6,14 @@ Copyright © 2018 Jean-Christophe Bos & HC² (www.hc2.fr)
 
 from    json        import loads, dumps
 from    os          import stat
-from    _thread     import start_new_thread
+from    _thread     import start_new_thread, allocate_lock
 import  socket
 import  gc
-import  re
+
+try :
+    from time import ticks_ms, ticks_diff
+except :
+    from ticks import ticks_ms, ticks_diff     # CPython
 
 try :
     from microWebTemplate import MicroWebTemplate
@@ -21,13 +25,35 @@ try :
 except :
     pass
 
+try :
+    import uasyncio as asyncio
+except :
+    pass
+
 class MicroWebSrvRoute :
-    def __init__(self, route, method, func, routeArgNames, routeRegex) :
+    def __init__(self, route, method, func, routeArgNames) :
         self.route         = route        
         self.method        = method       
         self.func          = func         
         self.routeArgNames = routeArgNames
-        self.routeRegex    = routeRegex   
+
+
+class MicroWebSrvRouteNode :
+    def __init__(self) :
+        self.static = { }   # path segment -> MicroWebSrvRouteNode
+        self.params = [ ]   # [argType, MicroWebSrvRouteNode], 'int' ones first
+        self.routes = { }   # method -> MicroWebSrvRoute
+
+
+class MicroWebSrvStaticAsset :
+    def __init__(self, filepath, content, gzContent, headerBlock, gzHeaderBlock) :
+        self.filepath      = filepath
+        self.content       = content
+        self.gzContent     = gzContent
+        self.headerBlock   = headerBlock    # status line and headers, without Connection
+        self.gzHeaderBlock = gzHeaderBlock
+        self.size          = len(content) + len(headerBlock) \
+                           + (len(gzContent) + len(gzHeaderBlock) if gzContent else 0)
 
 
 class MicroWebSrv :
@@ -80,6 +106,8 @@ class MicroWebSrv :
 
     _pyhtmlPagesExt = '.pyhtml'
 
+    _typeGen = type((lambda : (yield))())
+
     # ============================================================================
     # ===( Class globals  )=======================================================
     # ============================================================================
@@ -161,6 +189,34 @@ class MicroWebSrv :
     def _isPyHTMLFile(filename) :
         return filename.lower().endswith(MicroWebSrv._pyhtmlPagesExt)
 
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _readFile(filepath) :
+        try :
+            with open(filepath, 'rb') as file :
+                return file.read()
+        except :
+            return None
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _gzipCompress(data) :
+        try :
+            import deflate, io      # MicroPython >= 1.21
+            buf = io.BytesIO()
+            with deflate.DeflateIO(buf, deflate.GZIP) as gz :
+                gz.write(data)
+            return buf.getvalue()
+        except ImportError :
+            pass
+        try :
+            import gzip             # CPython
+            return gzip.compress(data)
+        except ImportError :
+            return None
+
     # ============================================================================
     # ===( Constructor )==========================================================
     # ============================================================================
@@ -175,30 +231,39 @@ class MicroWebSrv :
         self._webPath       = webPath
         self._notFoundUrl   = None
         self._started       = False
+        self._poolLock      = None
+        self._poolIdle      = [ ]
+        self._poolQueue     = [ ]
+        self._poolMaxQueued = 0
+        self._poolStreams   = 0
+        self._poolMaxStreams = 0
+        self._asyncServer   = None
 
         self.MaxWebSocketRecvLen        = 1024
         self.WebSocketThreaded          = True
         self.AcceptWebSocketCallback    = None
         self.LetCacheStaticContentLevel = 2
-
-        self._routeHandlers = []
+        self.KeepAliveMaxRequests       = 0     # 0 disables persistent connections (always off without a worker pool)
+        self.KeepAliveTimeout           = 5     # seconds to wait for the next request
+        self.PoolMaxStreams             = None  # streams served at once, maxWorkers - 1 if None
+        self.PoolMaxQueueWait           = 2     # seconds a connection may wait for a worker
+        self.StaticCacheMaxBytes        = 0     # 0 disables the static asset cache
+        self.AsyncMaxContentLength      = 4096  # request content read ahead by StartAsync
+        self.AsyncMaxClients            = 8     # StartAsync answers 503 beyond, 0 for no limit
+        self.AsyncStats                 = None  # accept counters of StartAsync
+
+        self._staticCache     = { }
+        self._staticCacheLRU  = [ ]
+        self._staticCacheSize = 0
+        self._staticCacheLock = allocate_lock()
+
+        self.RouteCacheSize = 16
+
+        self._routeTrie     = MicroWebSrvRouteNode()
+        self._routeCache    = { }
         routeHandlers += self._docoratedRouteHandlers
         for route, method, func in routeHandlers :
-            routeParts = route.split('/')
-            # -> ['', 'users', '<uID>', 'addresses', '<addrID>', 'test', '<anotherID>']
-            routeArgNames = []
-            routeRegex    = ''
-            for s in routeParts :
-                if s.startswith('<') and s.endswith('>') :
-                    routeArgNames.append(s[1:-1])
-                    routeRegex += '/(\\w*)'
-                elif s :
-                    routeRegex += '/' + s
-            routeRegex += '$'
-            # -> '/users/(\w*)/addresses/(\w*)/test/(\w*)$'
-            routeRegex = re.compile(routeRegex)
-
-            self._routeHandlers.append(MicroWebSrvRoute(route, method, func, routeArgNames, routeRegex))
+            self._addRoute(route, method, func)
 
     # ============================================================================
     # ===( Server Process )=======================================================
@@ -213,14 +278,109 @@ class MicroWebSrv :
                 if ex.args and ex.args[0] == 113 :
                     break
                 continue
-            self._client(self, client, cliAddr)
+            if self._poolLock :
+                self._poolDispatch(client, cliAddr)
+            else :
+                self._client(self, client, cliAddr)
         self._started = False
+        if self._poolLock :
+            self._poolLock.acquire()
+            while self._poolIdle :
+                self._poolIdle.pop().release()
+            while self._poolQueue :
+                try :
+                    self._poolQueue.pop()[0].close()
+                except :
+                    pass
+            self._poolLock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def _poolDispatch(self, client, cliAddr) :
+        self._poolLock.acquire()
+        if self._poolIdle or len(self._poolQueue) < self._poolMaxQueued :
+            self._poolQueue.append((client, cliAddr, ticks_ms()))
+            if self._poolIdle :
+                self._poolIdle.pop().release()
+            client = None
+        self._poolLock.release()
+        if client :
+            # Saturated, refuse without parsing the request
+            MicroWebSrv._refuse(client)
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _refuse(client) :
+        try :
+            client.send(b"HTTP/1.1 503 Service Unavailable\r\n"
+                        b"Retry-After: 1\r\n"
+                        b"Content-Length: 0\r\n"
+                        b"Connection: close\r\n\r\n")
+        except :
+            pass
+        try :
+            client.close()
+        except :
+            pass
+
+    # ----------------------------------------------------------------------------
+
+    def _poolWorker(self, wakeLock) :
+        while True :
+            wakeLock.acquire()
+            while True :
+                self._poolLock.acquire()
+                if not self._started or not self._poolQueue :
+                    break
+                client, cliAddr, queued = self._poolQueue.pop(0)
+                self._poolLock.release()
+                if ticks_diff(ticks_ms(), queued) > self.PoolMaxQueueWait * 1000 :
+                    # Its client has likely given up already
+                    MicroWebSrv._refuse(client)
+                    continue
+                try :
+                    self._client(self, client, cliAddr)
+                except Exception as ex :
+                    print('MicroWebSrv worker exception: %s' % ex)
+            # _started is checked under the lock, a worker parking here is
+            # either woken by the server stopping or sees it stopped
+            if not self._started :
+                self._poolLock.release()
+                return
+            self._poolIdle.append(wakeLock)
+            self._poolLock.release()
+
+    # ----------------------------------------------------------------------------
+
+    def _startPool(self, maxWorkers, maxQueued) :
+        self._poolLock      = allocate_lock()
+        self._poolMaxQueued = maxQueued
+        self._started       = True
+        for i in range(maxWorkers) :
+            wakeLock = allocate_lock()
+            wakeLock.acquire()
+            if not MicroWebSrv._startThread(self._poolWorker, (wakeLock, )) :
+                break
+            self._poolLock.acquire()
+            self._poolIdle.append(wakeLock)
+            self._poolLock.release()
+        if not self._poolIdle :
+            # No worker could be started, handle clients serially
+            self._poolLock = None
+        # Counted on the workers actually started
+        self._poolMaxStreams = self.PoolMaxStreams
+        if self._poolMaxStreams is None :
+            self._poolMaxStreams = len(self._poolIdle) - 1
 
     # ============================================================================
     # ===( Functions )============================================================
     # ============================================================================
 
-    def Start(self, threaded=False) :
+    def Start(self, threaded=False, maxWorkers=0, maxQueued=4) :
+        """ Starts serving, with maxWorkers > 0 clients are handled by a
+            bounded pool of threads and answered with 503 when all workers
+            are busy and maxQueued connections are already waiting """
         if not self._started :
             self._server = socket.socket()
             self._server.setsockopt( socket.SOL_SOCKET,
@@ -228,6 +388,8 @@ class MicroWebSrv :
                                      1 )
             self._server.bind(self._srvAddr)
             self._server.listen(16)
+            if maxWorkers > 0 :
+                self._startPool(maxWorkers, maxQueued)
             if threaded :
                 MicroWebSrv._startThread(self._serverProcess)
             else :
@@ -235,9 +397,51 @@ class MicroWebSrv :
 
     # ----------------------------------------------------------------------------
 
+    def StartAsync(self, threaded=False, backlog=16) :
+        """ Serves clients as coroutines of the uasyncio event loop, run in
+            a thread of its own when threaded, else by the caller. Route
+            handlers keep their arguments and may be generators: they yield
+            from httpResponse.Flush() to send what they wrote so far, and
+            from any coroutine while they wait """
+        if not self._started :
+            self._started = True
+            self.AsyncStats = asyncio.ServerStats()
+            self._asyncServer = asyncio.start_server( self._asyncAccept,
+                                                      self._srvAddr[0],
+                                                      self._srvAddr[1],
+                                                      backlog,
+                                                      self.AsyncMaxClients,
+                                                      self.AsyncStats )
+            loop = asyncio.get_event_loop()
+            loop.create_task(self._asyncRun(self._asyncServer))
+            if threaded :
+                MicroWebSrv._startThread(loop.run_forever)
+
+    # ----------------------------------------------------------------------------
+
+    def _asyncRun(self, server) :
+        # Stop() may be called from any thread but the loop is not thread
+        # safe, the server is cancelled from the loop once Stop() dropped it
+        task = asyncio.get_event_loop().create_task(server)
+        while self._asyncServer is server :
+            yield from asyncio.sleep_ms(250)
+        task.cancel()
+
+    # ----------------------------------------------------------------------------
+
+    def _asyncAccept(self, reader, writer) :
+        return MicroWebSrv._asyncClient(self, reader, writer).Serve()
+
+    # ----------------------------------------------------------------------------
+
     def Stop(self) :
         if self._started :
-            self._server.close()
+            if self._asyncServer :
+                # Cancelled and closed by _asyncRun()
+                self._asyncServer = None
+                self._started     = False
+            else :
+                self._server.close()
 
     # ----------------------------------------------------------------------------
 
@@ -246,6 +450,30 @@ class MicroWebSrv :
 
     # ----------------------------------------------------------------------------
 
+    def AcquireStream(self) :
+        """ Called by route handlers holding their worker for long (streams,
+            long polls), returns False when they should answer 503 instead:
+            at most PoolMaxStreams of them run at once so a worker is left
+            for the other requests. Always True without a worker pool """
+        if not self._poolLock :
+            return True
+        self._poolLock.acquire()
+        ok = self._poolStreams < self._poolMaxStreams
+        if ok :
+            self._poolStreams += 1
+        self._poolLock.release()
+        return ok
+
+    # ----------------------------------------------------------------------------
+
+    def ReleaseStream(self) :
+        if self._poolLock :
+            self._poolLock.acquire()
+            self._poolStreams -= 1
+            self._poolLock.release()
+
+    # ----------------------------------------------------------------------------
+
     def SetNotFoundPageUrl(self, url=None) :
         self._notFoundUrl = url
 
@@ -260,29 +488,177 @@ class MicroWebSrv :
 
     # ----------------------------------------------------------------------------
     
+    def _addRoute(self, route, method, func) :
+        # '/users/<uID>/addresses/<int:addrID>' -> static node 'users', untyped
+        # parameter node, static node 'addresses', 'int' parameter node
+        node          = self._routeTrie
+        routeArgNames = []
+        for s in route.split('/') :
+            if s.startswith('<') and s.endswith('>') :
+                argName = s[1:-1]
+                argType = None
+                if ':' in argName :
+                    argType, argName = argName.split(':', 1)
+                    if argType not in ('int', 'str') :
+                        raise ValueError('Unknown route argument type "%s" in %s' % (argType, route))
+                routeArgNames.append(argName)
+                for param in node.params :
+                    if param[0] == argType :
+                        node = param[1]
+                        break
+                else :
+                    param = [argType, MicroWebSrvRouteNode()]
+                    if argType == 'int' :
+                        node.params.insert(0, param)
+                    else :
+                        node.params.append(param)
+                    node = param[1]
+            elif s :
+                if s not in node.static :
+                    node.static[s] = MicroWebSrvRouteNode()
+                node = node.static[s]
+        method = method.upper()
+        if method not in node.routes :   # first registered route wins
+            node.routes[method] = MicroWebSrvRoute(route, method, func, routeArgNames)
+
+    # ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _routeArgValue(argType, s) :
+        # Returns the value of a path segment for a parameter node, None if
+        # it doesn't match (untyped parameters match \w* and are converted
+        # to int when possible)
+        if argType == 'int' :
+            try :
+                return int(s)
+            except :
+                return None
+        for c in s :
+            if not (c.isalpha() or c.isdigit() or c == '_') :
+                return None
+        if argType is None and s and s.isdigit() :
+            return int(s)
+        return s
+
+    # ----------------------------------------------------------------------------
+
+    def _matchRoute(self, node, segs, i, method, values) :
+        if i == len(segs) :
+            return node.routes.get(method)
+        seg   = segs[i]
+        child = node.static.get(seg)
+        if child :
+            rh = self._matchRoute(child, segs, i+1, method, values)
+            if rh :
+                return rh
+        for argType, child in node.params :
+            value = MicroWebSrv._routeArgValue(argType, seg)
+            if value is not None :
+                values.append(value)
+                rh = self._matchRoute(child, segs, i+1, method, values)
+                if rh :
+                    return rh
+                values.pop()
+        return None
+
+    # ----------------------------------------------------------------------------
+    
     def GetRouteHandler(self, resUrl, method) :
-        if self._routeHandlers :
-            #resUrl = resUrl.upper()
-            if resUrl.endswith('/') :
-                resUrl = resUrl[:-1]
-            method = method.upper()
-            for rh in self._routeHandlers :
-                if rh.method == method :
-                    m = rh.routeRegex.match(resUrl)
-                    if m :   # found matching route?
-                        if rh.routeArgNames :
-                            routeArgs = {}
-                            for i, name in enumerate(rh.routeArgNames) :
-                                value = m.group(i+1)
-                                try :
-                                    value = int(value)
-                                except :
-                                    pass
-                                routeArgs[name] = value
-                            return (rh.func, routeArgs)
-                        else :
-                            return (rh.func, None)
-        return (None, None)
+        if resUrl.endswith('/') :
+            resUrl = resUrl[:-1]
+        method = method.upper()
+        key    = method + resUrl
+        res    = self._routeCache.get(key)
+        if not res :
+            values = [ ]
+            rh     = self._matchRoute(self._routeTrie, resUrl.split('/')[1:], 0, method, values)
+            if not rh :
+                res = (None, None)
+            elif rh.routeArgNames :
+                res = (rh.func, dict(zip(rh.routeArgNames, values)))
+            else :
+                res = (rh.func, None)
+            if self.RouteCacheSize > 0 :
+                # Starts over when full instead of keeping an LRU order, hot
+                # paths come back at once. Swapping the dict needs no lock.
+                cache = self._routeCache
+                if len(cache) >= self.RouteCacheSize :
+                    self._routeCache = { key : res }
+                else :
+                    cache[key] = res
+        if res[1] :
+            return (res[0], dict(res[1]))   # handlers may modify their copy
+        return res
+
+    # ----------------------------------------------------------------------------
+
+    def GetStaticAsset(self, filepath, contentType=None, contentCharset=None, headers=None) :
+        """ Returns the cached MicroWebSrvStaticAsset of a file, loading it
+            (and its gzip variant, from filepath + '.gz' or compressed once)
+            when it fits in StaticCacheMaxBytes, least recently used assets
+            being evicted. Returns None when it can't be cached. """
+        if self.StaticCacheMaxBytes <= 0 :
+            return None
+        key  = ( filepath, contentType, contentCharset,
+                 tuple(headers.items()) if isinstance(headers, dict) else None )
+        lock = self._staticCacheLock
+        lock.acquire()
+        asset = self._staticCache.get(key)
+        if asset :
+            self._staticCacheLRU.remove(key)
+            self._staticCacheLRU.append(key)
+        lock.release()
+        if asset :
+            return asset
+
+        content = MicroWebSrv._readFile(filepath)
+        if not content or len(content) > self.StaticCacheMaxBytes :
+            return None
+        gzContent = MicroWebSrv._readFile(filepath + '.gz')
+        if gzContent is None :
+            gzContent = MicroWebSrv._gzipCompress(content)
+        if gzContent and len(gzContent) >= len(content) * 9 // 10 :
+            gzContent = None    # not worth the memory
+
+        contentType = (contentType or self.GetMimeTypeFromFilename(filepath) or "application/octet-stream") \
+                    + (("; charset=%s" % contentCharset) if contentCharset else "")
+        hdr = "HTTP/1.1 200 OK\r\nContent-Type: %s\r\n" % contentType
+        if isinstance(headers, dict) :
+            for header in headers :
+                hdr += "%s: %s\r\n" % (header, headers[header])
+        if gzContent :
+            hdr += "Vary: Accept-Encoding\r\n"
+        hdr += "Server: MicroWebSrv by JC`zic\r\n"
+        headerBlock   = ("%sContent-Length: %s\r\n" % (hdr, len(content))).encode()
+        gzHeaderBlock = ( "%sContent-Encoding: gzip\r\nContent-Length: %s\r\n"
+                          % (hdr, len(gzContent)) ).encode() if gzContent else None
+        asset = MicroWebSrvStaticAsset(filepath, content, gzContent, headerBlock, gzHeaderBlock)
+        if asset.size > self.StaticCacheMaxBytes :
+            asset.gzContent = asset.gzHeaderBlock = None
+            asset.size      = len(content) + len(headerBlock)
+            if asset.size > self.StaticCacheMaxBytes :
+                return None
+
+        lock.acquire()
+        if key not in self._staticCache :
+            while self._staticCacheSize + asset.size > self.StaticCacheMaxBytes :
+                old = self._staticCache.pop(self._staticCacheLRU.pop(0))
+                self._staticCacheSize -= old.size
+            self._staticCache[key] = asset
+            self._staticCacheLRU.append(key)
+            self._staticCacheSize += asset.size
+        lock.release()
+        gc.collect()
+        return asset
+
+    # ----------------------------------------------------------------------------
+
+    def ClearStaticCache(self) :
+        self._staticCacheLock.acquire()
+        self._staticCache     = { }
+        self._staticCacheLRU  = [ ]
+        self._staticCacheSize = 0
+        self._staticCacheLock.release()
 
     # ----------------------------------------------------------------------------
 
@@ -311,6 +687,43 @@ class MicroWebSrv :
             self._microWebSrv   = microWebSrv
             self._socket        = socket
             self._addr          = addr
+            
+            if hasattr(socket, 'readline'):   # MicroPython
+                self._socketfile = self._socket
+            else:   # CPython
+                self._socketfile = self._socket.makefile('rwb')
+
+            # Response headers are assembled here and sent along with the
+            # first piece of content, reused by every request of the connection
+            self._hdrBuf = bytearray(256)
+            self._hdrLen = 0
+
+            # Requests are read from the same socket file one after the other,
+            # so pipelined requests already buffered are served in order
+            # Without a pool clients are served one after the other by the
+            # server thread, an idle connection would hold up all the others
+            maxRequests = microWebSrv.KeepAliveMaxRequests if microWebSrv._poolLock else 0
+            count = 0
+            while True :
+                self._initRequest()
+                count += 1
+                self._keepAlive = count < maxRequests
+                keep = self._processRequest()
+                if keep is None :
+                    return      # socket handed over (WebSocket)
+                if not keep :
+                    break
+                socket.settimeout(microWebSrv.KeepAliveTimeout)
+            try :
+                if self._socketfile is not self._socket:
+                    self._socketfile.close()
+                self._socket.close()
+            except :
+                pass
+
+        # ------------------------------------------------------------------------
+
+        def _initRequest(self) :
             self._method        = None
             self._path          = None
             self._httpVer       = None
@@ -320,34 +733,68 @@ class MicroWebSrv :
             self._headers       = { }
             self._contentType   = None
             self._contentLength = 0
-            
-            if hasattr(socket, 'readline'):   # MicroPython
-                self._socketfile = self._socket
-            else:   # CPython
-                self._socketfile = self._socket.makefile('rwb')
-                        
-            self._processRequest()
+            self._contentRead   = 0
+            self._responded     = False
+            self._pending       = None      # (coroutine, response) of an async handler
+
+        # ------------------------------------------------------------------------
+
+        _coroHandlers = False   # handlers returning a coroutine (async server only)
+        _upgradable   = True    # the socket can be handed over (WebSocket)
+
+        def _newResponse(self) :
+            return MicroWebSrv._response(self)
+
+        # ------------------------------------------------------------------------
+
+        def _updateKeepAlive(self) :
+            conn = self._headers.get('connection', '').lower()
+            if self._httpVer == 'HTTP/1.1' :
+                if 'close' in conn :
+                    self._keepAlive = False
+            elif 'keep-alive' not in conn :
+                self._keepAlive = False
+
+        # ------------------------------------------------------------------------
+
+        def _skipRequestContent(self) :
+            # An unread body would be parsed as the next request
+            left = self._contentLength - self._contentRead
+            if left > 0 :
+                if left > 4096 or len(self.ReadRequestContent(left)) < left :
+                    self._keepAlive = False
 
         # ------------------------------------------------------------------------
 
         def _processRequest(self) :
             try :
-                response = MicroWebSrv._response(self)
+                response = self._newResponse()
                 if self._parseFirstLine(response) :
+                    self._socket.settimeout(2)
                     if self._parseHeader(response) :
+                        self._updateKeepAlive()
                         upg = self._getConnUpgrade()
                         if not upg :
                             routeHandler, routeArgs = self._microWebSrv.GetRouteHandler(self._resPath, self._method)
+                            if not routeHandler and self._method == "HEAD" :
+                                # Served by the GET handler, bodies are dropped by the response
+                                routeHandler, routeArgs = self._microWebSrv.GetRouteHandler(self._resPath, "GET")
                             if routeHandler :
                                 try :
                                     if routeArgs is not None:
-                                        routeHandler(self, response, routeArgs)
+                                        res = routeHandler(self, response, routeArgs)
                                     else :
-                                        routeHandler(self, response)
+                                        res = routeHandler(self, response)
+                                    if type(res) is MicroWebSrv._typeGen :
+                                        if not self._coroHandlers :
+                                            raise Exception('coroutine handlers need StartAsync()')
+                                        # Run by the async server, which ends the request
+                                        self._pending = (res, response)
+                                        return self._keepAlive
                                 except Exception as ex :
                                     print('MicroWebSrv handler exception:\r\n  - In route %s %s\r\n  - %s' % (self._method, self._resPath, ex))
                                     raise ex
-                            elif self._method.upper() == "GET" :
+                            elif self._method.upper() in ("GET", "HEAD") :
                                 filepath = self._microWebSrv._physPathFromURLPath(self._resPath)
                                 if filepath :
                                     if MicroWebSrv._isPyHTMLFile(filepath) :
@@ -362,9 +809,9 @@ class MicroWebSrv :
                                                 else:
                                                     headers = { 'Last-Modified' : 'Fri, 1 Jan 2018 23:42:00 GMT', \
                                                                 'Cache-Control' : 'max-age=315360000' }
-                                                    response.WriteResponseFile(filepath, contentType, headers)
+                                                    response.WriteResponseStaticFile(filepath, contentType, headers=headers)
                                             else :
-                                                response.WriteResponseFile(filepath, contentType)
+                                                response.WriteResponseStaticFile(filepath, contentType)
                                         else :
                                             response.WriteResponseForbidden()
                                 else :
@@ -372,26 +819,48 @@ class MicroWebSrv :
                             else :
                                 response.WriteResponseMethodNotAllowed()
                         elif upg == 'websocket' and 'MicroWebSocket' in globals() \
-                             and self._microWebSrv.AcceptWebSocketCallback :
+                             and self._microWebSrv.AcceptWebSocketCallback and self._upgradable :
                                 MicroWebSocket( socket         = self._socket,
                                                 httpClient     = self,
                                                 httpResponse   = response,
                                                 maxRecvLen     = self._microWebSrv.MaxWebSocketRecvLen,
                                                 threaded       = self._microWebSrv.WebSocketThreaded,
                                                 acceptCallback = self._microWebSrv.AcceptWebSocketCallback )
-                                return
+                                return None
                         else :
                             response.WriteResponseNotImplemented()
+                        self._completeRequest()
                     else :
+                        self._keepAlive = False
                         response.WriteResponseBadRequest()
+                else :
+                    self._keepAlive = False
             except :
+                self._keepAlive = False
                 response.WriteResponseInternalServerError()
+            return self._endRequest(response)
+
+        # ------------------------------------------------------------------------
+
+        def _completeRequest(self) :
+            if not self._responded :
+                self._keepAlive = False     # handler wrote nothing
+            elif self._keepAlive :
+                self._skipRequestContent()
+
+        # ------------------------------------------------------------------------
+
+        def _endRequest(self, response) :
             try :
-                if self._socketfile is not self._socket:
-                    self._socketfile.close()
-                self._socket.close()
+                response._flushHeader()     # responses without content
             except :
-                pass
+                self._keepAlive = False
+            if self._socketfile is not self._socket :
+                try :
+                    self._socketfile.flush()   # CPython buffers writes
+                except :
+                    self._keepAlive = False
+            return self._keepAlive
 
         # ------------------------------------------------------------------------
 
@@ -507,7 +976,9 @@ class MicroWebSrv :
                 size = self._contentLength
             if size > 0 :
                 try :
-                    return self._socketfile.read(size)
+                    data = self._socketfile.read(size)
+                    self._contentRead += len(data)
+                    return data
                 except :
                     pass
             return b''
@@ -545,34 +1016,123 @@ class MicroWebSrv :
 
         # ------------------------------------------------------------------------
 
+        _coalesceMaxLen = 1024     # content copied behind the headers
+
+        # ------------------------------------------------------------------------
+
         def __init__(self, client) :
             self._client = client
 
         # ------------------------------------------------------------------------
 
+        def _send(self, data) :
+            data = memoryview(data)
+            while data :
+                n = self._client._socketfile.write(data)
+                if n is None :
+                    return False
+                data = data[n:]
+            return True
+
+        # ------------------------------------------------------------------------
+
+        def _sendWithHeader(self, data) :
+            # Sends the pending header block and data with as few syscalls as
+            # possible: one vectored send when the socket has sendmsg, one
+            # write of both for small data, else one write for each
+            client  = self._client
+            sock    = client._socket
+            sendmsg = hasattr(sock, 'sendmsg')
+            if not sendmsg and len(data) <= self._coalesceMaxLen :
+                self._appendHeader(data)
+            hdr = memoryview(client._hdrBuf)[:client._hdrLen]
+            client._hdrLen = 0
+            if sendmsg :
+                if client._socketfile is not sock :
+                    client._socketfile.flush()
+                data = memoryview(data)
+                n    = sock.sendmsg([hdr, data])
+                if n < len(hdr) :
+                    if not self._sendRaw(hdr[n:]) :
+                        return False
+                    n = len(hdr)
+                return self._sendRaw(data[n - len(hdr):])
+            if len(data) <= self._coalesceMaxLen :
+                return self._send(hdr)
+            return self._send(hdr) and self._send(data)
+
+        # ------------------------------------------------------------------------
+
+        def _sendRaw(self, data) :
+            while data :
+                n = self._client._socket.send(data)
+                if not n :
+                    return False
+                data = data[n:]
+            return True
+
+        # ------------------------------------------------------------------------
+
         def _write(self, data, strEncoding='ISO-8859-1') :
             if data :
                 if type(data) == str :
                     data = data.encode(strEncoding)
-                data = memoryview(data)
-                while data :
-                    n = self._client._socketfile.write(data)
-                    if n is None :
-                        return False
-                    data = data[n:]
-                return True
+                try :
+                    if self._client._hdrLen :
+                        ok = self._sendWithHeader(data)
+                    else :
+                        ok = self._send(data)
+                except :
+                    # A partial response can't be followed by another one
+                    self._client._keepAlive = False
+                    raise
+                if not ok :
+                    self._client._keepAlive = False
+                return ok
             return False
 
         # ------------------------------------------------------------------------
 
+        def _appendHeader(self, data, strEncoding='ISO-8859-1') :
+            if type(data) == str :
+                data = data.encode(strEncoding)
+            client = self._client
+            start  = client._hdrLen
+            end    = start + len(data)
+            if end > len(client._hdrBuf) :
+                buf = bytearray(end + 128)
+                buf[:start] = client._hdrBuf[:start]
+                client._hdrBuf = buf
+            client._hdrBuf[start:end] = data
+            client._hdrLen = end
+            return True
+
+        # ------------------------------------------------------------------------
+
+        def _flushHeader(self) :
+            client = self._client
+            if client._hdrLen :
+                hdr = memoryview(client._hdrBuf)[:client._hdrLen]
+                client._hdrLen = 0
+                try :
+                    if not self._send(hdr) :
+                        client._keepAlive = False
+                except :
+                    client._keepAlive = False
+                    raise
+
+        # ------------------------------------------------------------------------
+
         def _writeFirstLine(self, code) :
+            self._client._responded = True
+            self._client._hdrLen    = 0
             reason = self._responseCodes.get(code, ('Unknown reason', ))[0]
-            return self._write("HTTP/1.1 %s %s\r\n" % (code, reason))
+            return self._appendHeader("HTTP/1.1 %s %s\r\n" % (code, reason))
 
         # ------------------------------------------------------------------------
 
         def _writeHeader(self, name, value) :
-            return self._write("%s: %s\r\n" % (name, value))
+            return self._appendHeader("%s: %s\r\n" % (name, value))
 
         # ------------------------------------------------------------------------
 
@@ -591,21 +1151,42 @@ class MicroWebSrv :
 
         # ------------------------------------------------------------------------
 
+        def _writeConnectionHeader(self) :
+            client = self._client
+            if client._keepAlive and client._microWebSrv._poolQueue :
+                # Don't hold a pool worker on an idle connection while other
+                # clients are waiting for one, decided before the client is
+                # told the connection stays open
+                client._keepAlive = False
+            self._writeHeader("Connection", "keep-alive" if client._keepAlive else "close")
+
+        # ------------------------------------------------------------------------
+
         def _writeEndHeader(self) :
-            return self._write("\r\n")
+            return self._appendHeader("\r\n")
+
+        # ------------------------------------------------------------------------
+
+        def _isHead(self) :
+            return self._client._method == "HEAD"
 
         # ------------------------------------------------------------------------
 
         def _writeBeforeContent(self, code, headers, contentType, contentCharset, contentLength) :
+            if code == 503 :
+                # A client told to come back later doesn't hold a worker
+                self._client._keepAlive = False
             self._writeFirstLine(code)
             if isinstance(headers, dict) :
                 for header in headers :
                     self._writeHeader(header, headers[header])
             if contentLength > 0 :
                 self._writeContentTypeHeader(contentType, contentCharset)
+            if code != 204 and code != 304 :
+                # Always framed, the connection may carry another response
                 self._writeHeader("Content-Length", contentLength)
             self._writeServerHeader()
-            self._writeHeader("Connection", "close")
+            self._writeConnectionHeader()
             self._writeEndHeader()
 
         # ------------------------------------------------------------------------
@@ -619,6 +1200,7 @@ class MicroWebSrv :
                     self._writeHeader(header, headers[header])
             self._writeServerHeader()
             self._writeEndHeader()
+            self._flushHeader()
             if self._client._socketfile is not self._client._socket :
                 self._client._socketfile.flush()   # CPython needs flush to continue protocol
 
@@ -633,7 +1215,7 @@ class MicroWebSrv :
                 else :
                     contentLength = 0
                 self._writeBeforeContent(code, headers, contentType, contentCharset, contentLength)
-                if content :
+                if content and not self._isHead() :
                     return self._write(content)
                 return True
             except :
@@ -641,6 +1223,40 @@ class MicroWebSrv :
 
         # ------------------------------------------------------------------------
 
+        def WriteResponseMultipartStart(self, boundary, headers=None) :
+            # The stream only ends when the connection does
+            self._client._keepAlive = False
+            try :
+                self._writeFirstLine(200)
+                if isinstance(headers, dict) :
+                    for header in headers :
+                        self._writeHeader(header, headers[header])
+                self._writeContentTypeHeader("multipart/x-mixed-replace; boundary=%s" % boundary)
+                self._writeServerHeader()
+                self._writeHeader("Connection", "close")
+                self._writeEndHeader()
+                return not self._isHead()
+            except :
+                return False
+
+        # ------------------------------------------------------------------------
+
+        def WriteResponseMultipartPart(self, boundary, contentType, content) :
+            try :
+                # The CRLF ending the previous part starts this one's delimiter,
+                # so each part goes out as a single header + content write
+                self._appendHeader( "\r\n--%s\r\nContent-Type: %s\r\nContent-Length: %s\r\n\r\n"
+                                    % (boundary, contentType, len(content)) )
+                if not self._write(content) :
+                    return False
+                if self._client._socketfile is not self._client._socket :
+                    self._client._socketfile.flush()   # CPython buffers writes
+                return True
+            except :
+                return False
+
+        # ------------------------------------------------------------------------
+
         def WriteResponsePyHTMLFile(self, filepath, headers=None, vars=None) :
             if 'MicroWebTemplate' in globals() :
                 with open(filepath, 'r') as file :
@@ -668,6 +1284,8 @@ class MicroWebSrv :
                 if size > 0 :
                     with open(filepath, 'rb') as file :
                         self._writeBeforeContent(200, headers, contentType, None, size)
+                        if self._isHead() :
+                            return True
                         try :
                             buf = bytearray(1024)
                             while size > 0 :
@@ -688,6 +1306,32 @@ class MicroWebSrv :
 
         # ------------------------------------------------------------------------
 
+        def WriteResponseStaticFile(self, filepath, contentType=None, contentCharset=None, headers=None) :
+            asset = self._client._microWebSrv.GetStaticAsset(filepath, contentType, contentCharset, headers)
+            if not asset :
+                if contentCharset :
+                    contentType = "%s; charset=%s" % (contentType, contentCharset)
+                return self.WriteResponseFile(filepath, contentType, headers)
+            try :
+                self._client._responded = True
+                self._client._hdrLen    = 0
+                if asset.gzContent and \
+                   'gzip' in self._client._headers.get('accept-encoding', '') :
+                    self._appendHeader(asset.gzHeaderBlock)
+                    content = asset.gzContent
+                else :
+                    self._appendHeader(asset.headerBlock)
+                    content = asset.content
+                self._writeConnectionHeader()
+                self._writeEndHeader()
+                if self._isHead() :
+                    return True
+                return self._write(content)
+            except :
+                return False
+
+        # ------------------------------------------------------------------------
+
         def WriteResponseFileAttachment(self, filepath, attachmentName, headers=None) :
             if not isinstance(headers, dict) :
                 headers = { }
@@ -735,8 +1379,9 @@ class MicroWebSrv :
 
         # ------------------------------------------------------------------------
 
-        def WriteResponseNotModified(self) :
-            return self.WriteResponseError(304)
+        def WriteResponseNotModified(self, headers=None) :
+            # A 304 never has a body
+            return self.WriteResponse(304, headers, None, None, None)
 
         # ------------------------------------------------------------------------
 
@@ -874,6 +1519,220 @@ class MicroWebSrv :
             505: ('HTTP Version Not Supported', 'Cannot fulfill request.'),
         }
 
+    # ============================================================================
+    # ===( Class Async Client  )==================================================
+    # ============================================================================
+
+    class _asyncClient(_client) :
+
+        # ------------------------------------------------------------------------
+
+        _coroHandlers = True
+        _upgradable   = False
+
+        _maxHeadLen   = 4096
+
+        # ------------------------------------------------------------------------
+
+        def __init__(self, microWebSrv, reader, writer) :
+            self._microWebSrv   = microWebSrv
+            self._reader        = reader
+            self._writer        = writer
+            self._addr          = writer.get_extra_info('peername')
+
+            # The request head (and small content) is read ahead by the
+            # coroutine, the parser then reads it from this buffer
+            self._socket        = MicroWebSrv._requestBuffer()
+            self._socketfile    = self._socket
+
+            self._hdrBuf = bytearray(256)
+            self._hdrLen = 0
+            self._out    = [ ]      # response data the socket didn't take yet
+            self._tooLarge = False  # content beyond AsyncMaxContentLength
+
+        # ------------------------------------------------------------------------
+
+        def Serve(self) :
+            try :
+                yield from self._serveRequests()
+            except Exception :
+                # Cancelled, or the connection failed
+                pass
+            try :
+                yield from self._writer.aclose()
+            except :
+                pass
+
+        # ------------------------------------------------------------------------
+
+        def _serveRequests(self) :
+            srv   = self._microWebSrv
+            count = 0
+            while True :
+                self._initRequest()
+                count += 1
+                self._keepAlive = count < srv.KeepAliveMaxRequests
+                timeout = 2000 if count == 1 else srv.KeepAliveTimeout * 1000
+                try :
+                    if not (yield from asyncio.wait_for_ms(self._readHead(), timeout)) :
+                        break
+                except asyncio.TimeoutError :
+                    break
+                if self._tooLarge :
+                    self._newResponse().WriteResponseError(413)
+                    yield from self._flushOut()
+                    break
+                self._processRequest()
+                if self._pending :
+                    yield from self._runHandler()
+                if not (yield from self._flushOut()) or not self._keepAlive :
+                    break
+
+        # ------------------------------------------------------------------------
+
+        def _readHead(self) :
+            lines = [ ]
+            line  = b''
+            size  = 0
+            while True :
+                # Pieces of at most the reader's buffer, the head is
+                # bounded before a long line is joined
+                part  = yield from self._reader.readuntil(b'\n')
+                size += len(part)
+                if not part or size > self._maxHeadLen :
+                    return False
+                line += part
+                if line[-1] != 0x0a :
+                    continue    # longer than the reader's buffer
+                if line == b'\r\n' or line == b'\n' :
+                    break
+                lines.append(line)
+                line = b''
+            length = 0
+            for line in lines :
+                if line[:15].lower() == b'content-length:' :
+                    try :
+                        length = int(line[15:])
+                    except :
+                        pass
+            content = b''
+            if length > self._microWebSrv.AsyncMaxContentLength :
+                # Not read ahead, answered with 413 instead of dispatched
+                # with empty content, and the connection can't be reused
+                self._tooLarge  = True
+                self._keepAlive = False
+                return True
+            if length > 0 :
+                content = yield from self._reader.readexactly(length)
+            lines.append(b'\r\n')
+            self._socketfile.feed(lines, content)
+            return True
+
+        # ------------------------------------------------------------------------
+
+        def _runHandler(self) :
+            coro, response = self._pending
+            self._pending  = None
+            try :
+                yield from coro
+                self._completeRequest()
+            except Exception as ex :
+                print('MicroWebSrv handler exception:\r\n  - In route %s %s\r\n  - %s' % (self._method, self._resPath, ex))
+                self._keepAlive = False
+                if not self._responded :
+                    response.WriteResponseInternalServerError()
+            self._endRequest(response)
+
+        # ------------------------------------------------------------------------
+
+        def _flushOut(self) :
+            out = self._out
+            try :
+                while out :
+                    yield from self._writer.awrite(out.pop(0))
+                return True
+            except OSError :
+                del out[:]
+                self._keepAlive = False
+                return False
+
+        # ------------------------------------------------------------------------
+
+        def _newResponse(self) :
+            return MicroWebSrv._asyncResponse(self)
+
+    # ============================================================================
+    # ===( Class Async Response  )================================================
+    # ============================================================================
+
+    class _asyncResponse(_response) :
+
+        # ------------------------------------------------------------------------
+
+        def _send(self, data) :
+            # Written straight to the non-blocking socket while nothing is
+            # pending, the rest waits for Flush() or the end of the handler
+            client = self._client
+            keep   = type(data) is bytes
+            data   = memoryview(data)
+            if not client._out :
+                try :
+                    n = client._writer.s.write(data)
+                except OSError :
+                    return False
+                if n == len(data) :
+                    return True
+                if n :
+                    data = data[n:]
+            # Only immutable data can be referenced until it is sent
+            client._out.append(data if keep else bytes(data))
+            return True
+
+        # ------------------------------------------------------------------------
+
+        def Flush(self) :
+            """ Coroutine sending what the handler wrote so far, returns
+                False when the connection failed """
+            self._flushHeader()
+            return (yield from self._client._flushOut())
+
+    # ============================================================================
+    # ===( Class Request Buffer  )================================================
+    # ============================================================================
+
+    class _requestBuffer :
+
+        # ------------------------------------------------------------------------
+
+        def __init__(self) :
+            self._lines   = [ ]
+            self._content = b''
+
+        # ------------------------------------------------------------------------
+
+        def feed(self, lines, content) :
+            self._lines   = lines
+            self._content = content
+
+        # ------------------------------------------------------------------------
+
+        def readline(self) :
+            if self._lines :
+                return self._lines.pop(0)
+            return b''
+
+        # ------------------------------------------------------------------------
+
+        def read(self, size) :
+            data          = self._content[:size]
+            self._content = self._content[size:]
+            return data
+
+        # ------------------------------------------------------------------------
+
+        def settimeout(self, timeout) :
+            pass
+
     # ============================================================================
     # ============================================================================
     # ============================================================================
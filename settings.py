@@ -0,0 +1,160 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from ticks import ticks_ms, ticks_diff
+
+try:
+    from _thread import allocate_lock
+except ImportError:
+    allocate_lock = None
+
+try:
+    import camera
+except ImportError:     # off-device, same FRAME_* values
+    import camerabackend as camera
+
+# (name, camera setter, min, max, default), framesize first as it resets the sensor.
+# Up to UXGA, the largest size of the OV2640 sensor the page offers
+SETTINGS = (
+    ('framesize', 'framesize', 0, camera.FRAME_UXGA, camera.FRAME_VGA),
+    ('quality', 'quality', 10, 63, 10),
+    ('saturation', 'saturation', -2, 2, 0),
+    ('brightness', 'brightness', -2, 2, 0),
+    ('contrast', 'contrast', -2, 2, 0),
+    ('vflip', 'flip', 0, 1, 0),
+    ('hflip', 'mirror', 0, 1, 0)
+)
+
+
+class CameraSettings():
+    """
+    Sensor settings requested by the clients and those applied to the
+    camera. update() only records the values that differ from what will be
+    applied, apply() programs them in one batch and must run while the
+    camera is idle (FrameHub.hooks), so a capture never sees half of a
+    change. The applied state is saved to `path` once it stopped changing
+    for `save_ms`, sparing the flash while a slider is dragged.
+    """
+
+    def __init__(self, camera, path='camera.json', save_ms=5000):
+        self.camera = camera
+        self.path = path
+        self.save_ms = save_ms
+        self.values = {}
+        for name, setter, low, high, default in SETTINGS:
+            self.values[name] = default
+        self.applied = {}
+        self._dirty = {}
+        self._changed = None
+        self._saved = None
+        self._lock = allocate_lock() if allocate_lock else None
+        self.batches = 0
+        self.writes = 0
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def load(self):
+        """ Reads the saved settings, they are applied by the next apply() """
+        try:
+            with open(self.path) as f:
+                saved = json.loads(f.read())
+            self.update(saved)
+            self._saved = saved
+        except (OSError, ValueError, AttributeError):
+            # Nothing saved yet, or a write cut short by a reset
+            pass
+        # The camera starts with its own defaults, program everything once
+        self.reapply()
+
+    def reapply(self):
+        """ Programs every setting again, after the camera was reinitialised """
+        if self._lock:
+            self._lock.acquire()
+        self._dirty = dict(self.values)
+        if self._lock:
+            self._lock.release()
+
+    def update(self, changes):
+        """
+        Records a partial update, returns the names that changed. Raises
+        ValueError on an unknown name or a value out of range, leaving the
+        settings untouched.
+        """
+        valid = {}
+        for name, value in changes.items():
+            spec = None
+            for item in SETTINGS:
+                if item[0] == name:
+                    spec = item
+            if spec is None:
+                raise ValueError('Unknown setting: %s' % name)
+            try:
+                value = int(value)
+            except TypeError:
+                raise ValueError('%s is not a number' % name)
+            if value < spec[2] or value > spec[3]:
+                raise ValueError('%s out of range: %d' % (name, value))
+            valid[name] = value
+
+        if self._lock:
+            self._lock.acquire()
+        changed = []
+        for name, value in valid.items():
+            if self.values[name] != value:
+                self.values[name] = value
+                changed.append(name)
+            if self.applied.get(name) != value:
+                self._dirty[name] = value
+            elif name in self._dirty:
+                # Back to the applied value before apply() ran
+                del self._dirty[name]
+        if self._lock:
+            self._lock.release()
+        return changed
+
+    def apply(self):
+        """ Programs the changed settings, returns how many """
+        if self._dirty:
+            if self._lock:
+                self._lock.acquire()
+            dirty = self._dirty
+            self._dirty = {}
+            if self._lock:
+                self._lock.release()
+            for name, setter, low, high, default in SETTINGS:
+                if name in dirty:
+                    getattr(self.camera, setter)(dirty[name])
+                    self.applied[name] = dirty[name]
+            self.batches += 1
+            self._changed = ticks_ms()
+            return len(dirty)
+
+        if self._changed is not None and ticks_diff(ticks_ms(), self._changed) >= self.save_ms:
+            self._changed = None
+            self.save()
+        return 0
+
+    def save(self):
+        if self.applied == self._saved:
+            return
+        try:
+            with open(self.path, 'w') as f:
+                f.write(json.dumps(self.applied))
+            self._saved = dict(self.applied)
+            self.writes += 1
+        except OSError:
+            pass
@@ -0,0 +1,115 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# FrameHub driven by a fake camera under CPython (ticks.py fallbacks):
+# the number of captures must not depend on the number of viewers.
+#
+#   python -m pytest tests
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from framehub import FrameHub, Viewer
+from ticks import sleep_ms
+
+FRAMES = 10
+
+
+class FakeCamera():
+    # Stands in for the camera module, counting the captures
+
+    def __init__(self, capture_ms=20):
+        self.capture_ms = capture_ms
+        self.captures = 0
+
+    def capture(self):
+        sleep_ms(self.capture_ms)
+        self.captures += 1
+        return b'\xff\xd8frame %d\xff\xd9' % self.captures
+
+
+def stream(hub, frames, seqs):
+    after = 0
+    for i in range(frames):
+        frame = hub.get(after, timeout_ms=2000)
+        assert frame is not None
+        seqs.append(frame.seq)
+        after = frame.seq
+        hub.release(frame)
+
+
+def run_viewers(viewers):
+    camera = FakeCamera()
+    hub = FrameHub(camera.capture, poll_ms=1)
+    hub.start()
+    try:
+        seqs = [[] for i in range(viewers)]
+        threads = [threading.Thread(target=stream, args=(hub, FRAMES, seqs[i]))
+                   for i in range(viewers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        hub.stop()
+    return camera, hub, seqs
+
+
+def test_captures_do_not_grow_with_viewers():
+    camera1, hub1, seqs1 = run_viewers(1)
+    camera8, hub8, seqs8 = run_viewers(8)
+    for seqs in seqs1 + seqs8:
+        assert len(seqs) == FRAMES
+        assert seqs == sorted(set(seqs))
+    # Every viewer got its frames from the same captures, give or take
+    # the ones the producer took ahead
+    assert camera8.captures <= camera1.captures + hub8.depth + 1
+    assert hub8.captures == camera8.captures
+
+
+def test_no_capture_without_viewers():
+    camera = FakeCamera()
+    hub = FrameHub(camera.capture, poll_ms=1)
+    hub.start()
+    sleep_ms(100)
+    hub.stop()
+    assert camera.captures == 0
+
+
+def test_viewer_drops_only_frames_replaced_while_sending():
+    camera = FakeCamera(capture_ms=0)
+    hub = FrameHub(camera.capture)
+    viewer = Viewer(hub, 'test')
+    # Nothing published yet, this only registers the demand
+    assert viewer.get(timeout_ms=0) is None
+    hub.capture()
+    assert viewer.get().seq == 1
+    viewer.done()
+    # Published while the viewer waits on purpose, as with an fps cap
+    hub.capture()
+    hub.capture()
+    assert viewer.get().seq == 3
+    assert viewer.dropped == 0
+    # Published while it is still sending frame 3
+    hub.capture()
+    hub.capture()
+    viewer.done()
+    assert viewer.get().seq == 5
+    assert viewer.dropped == 1
+    viewer.done()
+    viewer.close()
+    assert viewer.sent == 3
+    assert hub.viewers == []
@@ -0,0 +1,55 @@
+# Copyright 2020 LeMaRiva|tech lemariva.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Builds the <file>.gz variants MicroWebSrv serves from the static asset
+# cache. MicroPython before 1.21 cannot compress them on the board, so
+# they are built here and uploaded along with the files. Run it again
+# after editing a file in www/, a stale .gz would still be served.
+#
+#   python tools/gzip_www.py [directory]
+
+import gzip
+import os
+import sys
+
+
+def build(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    # mtime=0 keeps the output identical between runs
+    gz = gzip.compress(content, 9, mtime=0)
+    if len(gz) >= len(content) * 9 // 10:
+        # MicroWebSrv would not keep it, see MicroWebSrv.GetStaticAsset
+        if os.path.exists(path + '.gz'):
+            os.remove(path + '.gz')
+        return None
+    with open(path + '.gz', 'wb') as f:
+        f.write(gz)
+    return len(content), len(gz)
+
+
+def main():
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), '..', 'www')
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if name.endswith('.gz') or not os.path.isfile(path):
+            continue
+        sizes = build(path)
+        if sizes:
+            print('%s.gz  %d -> %d bytes' % (name, sizes[0], sizes[1]))
+        else:
+            print('%s  not worth compressing' % name)
+
+
+main()
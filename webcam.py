@@ -1,13 +1,42 @@
 
-import camera
 import picoweb
-import machine
 import time
 import uasyncio as asyncio
 from config import *
-
-led = machine.Pin(app_config['led'], machine.Pin.OUT)
+from framehub import FrameHub, Viewer
+from camerabackend import get_camera
+from camerasession import CameraSession
+from camerawatchdog import CameraWatchdog
+
+try:
+    import machine
+    led = machine.Pin(app_config['led'], machine.Pin.OUT)
+except ImportError:     # off-device runs have no LED
+    led = None
 app = picoweb.WebApp('app')
+camera = get_camera(app_config)
+
+# A failing camera is reinitialised in the background
+watchdog = CameraWatchdog(camera)
+
+# Every viewer reads from the same producer. The next frame is captured
+# while the current one is sent.
+hub = FrameHub(watchdog.capture, depth=app_config.get('pipeline_depth', 2),
+               watchdog=watchdog)
+
+def camera_off():
+    watchdog.reset()
+    if led:
+        led.off()
+
+# The camera stays initialised while it is used and for a while after
+session = CameraSession(camera, idle_ms=app_config.get('camera_idle_ms', 30000),
+                        on_deinit=camera_off)
+
+def unavailable(resp):
+    # Fail fast while the watchdog recovers the camera
+    yield from picoweb.start_response(resp, status=503,
+                                      headers={'Retry-After': str(watchdog.retry_after() or 1)})
 
 import ulogging as logging
 logging.basicConfig(level=logging.INFO)
@@ -19,97 +48,91 @@ def index(req, resp):
     # parse query string
     req.parse_qs()
     flash = req.form.get('flash', 'false')
-    if flash == 'true':
+    if flash == 'true' and led:
         led.on()
     stream = req.form.get('stream', 'false')
     stream = True if stream == 'true' else False
         
-    # Camera resilience - if we fail to init try to deinit and init again
-    if app_config['camera'] == 'ESP32-CAM':
-        if (not camera.init(0, format=camera.JPEG)):
-            camera.deinit()
-            await asyncio.sleep(1)
-            # If we fail to init, return a 503
-            if (not camera.init(0, format=camera.JPEG)):  
-                yield from picoweb.start_response(resp, status=503)
-                yield from resp.awrite('ERROR: Failed to initialise camera\r\n\r\n')
-                return
-    elif app_config['camera'] == 'M5CAMERA':
-        if (not camera.init(0, d0=32, d1=35, d2=34, d3=5, d4=39, d5=18, d6=36, d7=19,
-                    href=26, vsync=25, reset=15, sioc=23, siod=22, xclk=27, pclk=21)):
-            camera.deinit()
-            await asyncio.sleep(1)
-            # If we fail to init, return a 503
-            if (not camera.init(0, d0=32, d1=35, d2=34, d3=5, d4=39, d5=18, d6=36, d7=19,
-                    href=26, vsync=25, reset=15, sioc=23, siod=22, xclk=27, pclk=21)):   #M5CAMERA  
-                yield from picoweb.start_response(resp, status=503)
-                yield from resp.awrite('ERROR: Failed to initialise camera\r\n\r\n')
-                return
+    # Cold start only when the camera was idle, else it is reused
+    if not (yield from session.acquire()):
+        # If we fail to init, return a 503
+        yield from picoweb.start_response(resp, status=503)
+        yield from resp.awrite('ERROR: Failed to initialise camera\r\n\r\n')
+        return
+    if watchdog.recovering:
+        session.release()
+        yield from unavailable(resp)
+        yield from resp.awrite('Camera unavailable\r\n')
+        return
 
-    # wait for sensor to start and focus before capturing image
-    await asyncio.sleep(2)
-    
     n_frame = 0
+    viewer = None
 
-    while True:
-        n_try = 0
-        buf = False
-        while (n_try < 10 and buf == False): #{
-            # wait for sensor to start and focus before capturing image
-            buf = camera.capture()
-            if (buf == False): await asyncio.sleep(2)
-            n_try = n_try + 1
-    
-
-        if (not stream):
-            led.off()
-            camera.deinit()
-    
-
-        if (type(buf) is bytes and len(buf) > 0):
-            try:
-                if (not stream):
-                    yield from picoweb.start_response(resp, "image/jpeg")
-                    yield from resp.awrite(buf)
-                    print('JPEG: Output frame')
-                    break
-            
-
-                if (n_frame == 0): 
-                    yield from picoweb.start_response(resp, "multipart/x-mixed-replace; boundary=myboundary")
-            
-
-                yield from resp.awrite('--myboundary\r\n')
-                yield from resp.awrite('Content-Type:   image/jpeg\r\n')
-                yield from resp.awrite('Content-length: ' + str(len(buf)) + '\r\n\r\n')
-                yield from resp.awrite(buf)
-
-            except:
-                # Connection gone?
-                print('Connection closed by client')
-                led.off()
-                camera.deinit()
-                return
+    try:
+        # A slow client skips frames, it never holds back the others
+        viewer = Viewer(hub, str(resp.get_extra_info('peername')))
+        while True:
+            # Returns None at once when the camera fails for good
+            frame = yield from viewer.aget(timeout_ms=5000)
 
-        else: 
-            if (stream):
+            if (not stream and led):
                 led.off()
-                camera.deinit()
-        
-
-            #picoweb.http_error(resp, 503)
-            yield from picoweb.start_response(resp, status=503)
-            if (stream and n_frame > 0): 
-                yield from resp.awrite('Content-Type:   text/html; charset=utf-8\r\n\r\n')
-            
-            yield from resp.awrite('Issues:\r\n\r\n' + str(buf))
-            return
-        
-
-        print('MJPEG: Output frame ' + str(n_frame))
-        n_frame = n_frame + 1
-    
 
+            if frame is not None:
+                try:
+                    if (not stream):
+                        yield from picoweb.start_response(resp, "image/jpeg")
+                        yield from resp.awrite(frame.buf)
+                        viewer.done()
+                        print('JPEG: Output frame')
+                        break
+
+                    if (n_frame == 0): 
+                        yield from picoweb.start_response(resp, "multipart/x-mixed-replace; boundary=myboundary")
+
+                    yield from resp.awrite('--myboundary\r\n')
+                    yield from resp.awrite('Content-Type:   image/jpeg\r\n')
+                    yield from resp.awrite('Content-length: ' + str(len(frame.buf)) + '\r\n\r\n')
+                    yield from resp.awrite(frame.buf)
+                    viewer.done()
+
+                except:
+                    # Connection gone?
+                    print('Connection closed by client')
+                    return
+
+            else: 
+                #picoweb.http_error(resp, 503)
+                yield from unavailable(resp)
+                if (stream and n_frame > 0): 
+                    yield from resp.awrite('Content-Type:   text/html; charset=utf-8\r\n\r\n')
+
+                yield from resp.awrite('Issues:\r\n\r\n' + str(hub.failures) + ' failed captures')
+                return
 
-def run():
-    app.run(host='0.0.0.0', port=80, debug=True)
+            print('MJPEG: Output frame ' + str(n_frame))
+            n_frame = n_frame + 1
+    finally:
+        if viewer:
+            viewer.close()
+        session.release()
+
+
+@app.route('/viewers')
+def viewers_stats(req, resp):
+    # Frames sent and dropped per streaming client
+    yield from picoweb.jsonify(resp, {
+        'captures': hub.captures,
+        'failures': hub.failures,
+        'skipped': hub.skipped,
+        'viewers': [viewer.stats() for viewer in hub.viewers],
+        'session': session.status(),
+        'camera': watchdog.status()
+    })
+
+
+def run(port=80):
+    loop = asyncio.get_event_loop()
+    loop.create_task(hub.arun())
+    loop.create_task(session.arun())
+    app.run(host='0.0.0.0', port=port, debug=True)
@@ -12,127 +12,397 @@ limitations under the License.
 """
 
 import gc
-import machine
 import json
 import time
-import camera
+
+try:
+    import machine
+except ImportError:     # off-device runs have no LED
+    machine = None
+
+try:
+    import uasyncio as asyncio
+except ImportError:     # only the async server needs it
+    asyncio = None
 
 from microWebSrv import MicroWebSrv
+from framehub import FrameHub, Viewer
+from adaptive import QualityController
+from settings import CameraSettings
+from camerawatchdog import CameraWatchdog
+from camerabackend import get_camera
+from ticks import ticks_ms, ticks_diff, sleep_ms
 
 class webcam():
 
     def __init__(self):
-        
-        self.saturation = 0
-        self.quality = 10
-        self.brightness = 0
-        self.contrast = 0
-        self.vflip = 0
-        self.hflip = 0
-        self.framesize = camera.FRAME_VGA
 
         self.routeHandlers = [
             ("/", "GET", self._httpHandlerIndex),
             ("/logo.svg", "GET", self._httpLogo),
             ("/stream/<d>", "GET", self._httpStream),
+            ("/mjpeg", "GET", self._httpMjpeg),
+            ("/frame/next", "GET", self._httpFrameNext),
+            ("/viewers", "GET", self._httpHandlerViewers),
+            ("/loop", "GET", self._httpHandlerLoop),
             ("/upy/<saturation>/<brightness>/<contrast>/<quality>/<vflip>/<hflip>/<framesize>", "GET", self._httpHandlerSetData),
+            ("/upy/adaptive", "GET", self._httpHandlerAdaptive),
             ("/upy", "GET", self._httpHandlerGetData),
+            ("/upy", "POST", self._httpHandlerPostData),
             ("/memory/<query>", "GET", self._httpHandlerMemory)
         ]
 
-    def run(self, app_config):
-        self.led = machine.Pin(app_config['led'], machine.Pin.OUT)
+        # Coroutine versions of the routes that wait for frames, used by
+        # the async server so a waiting client doesn't block the others
+        self.asyncHandlers = {
+            "/stream/<d>": self._httpStreamAsync,
+            "/mjpeg": self._httpMjpegAsync,
+            "/frame/next": self._httpFrameNextAsync
+        }
 
-        # Camera resilience - if we fail to init try to deinit and init again
-        if app_config['camera'] == 'ESP32-CAM':
-            camera.init(0, format=camera.JPEG, framesize=self.framesize)      #ESP32-CAM
+    def run(self, app_config, port=80):
+        if machine:
+            self.led = machine.Pin(app_config['led'], machine.Pin.OUT)
+
+        self.camera = get_camera(app_config)
+        # Last applied settings, programmed between captures
+        self.settings = CameraSettings(self.camera)
+        self.settings.load()
+        self.camera.init(framesize=self.settings['framesize'])
+
+        # A failing camera is reinitialised in the background
+        self.watchdog = CameraWatchdog(self.camera, on_reinit=self._cameraReinit)
+
+        # One producer captures for every viewer, ahead of the sends
+        self.hub = FrameHub(self.watchdog.capture,
+                            depth=app_config.get('pipeline_depth', 2),
+                            watchdog=self.watchdog)
+        # Optional closed loop on quality and frame size, off without targets
+        self.adaptive = QualityController(self.camera, self.hub,
+                                          target_fps=app_config.get('target_fps', 0),
+                                          max_bytes_s=app_config.get('max_bytes_s', 0),
+                                          quality=self.settings['quality'],
+                                          framesize=self.settings['framesize'])
+        self.hub.hooks.append(self.settings.apply)
+        self.hub.hooks.append(self.adaptive.step)
+        self.hub.start()
+
+        server = app_config.get('server', 'threaded')
+        routeHandlers = self.routeHandlers
+        if server == 'async':
+            routeHandlers = [(route, method, self.asyncHandlers.get(route, func))
+                             for route, method, func in routeHandlers]
+
+        mws = MicroWebSrv(routeHandlers=routeHandlers, port=port, webPath="www/")
+        # Snapshot polling and /upy calls reuse their connection
+        mws.KeepAliveMaxRequests = 100
+        mws.KeepAliveTimeout = 2
+        # index.html and logo.svg are read from flash only once
+        mws.StaticCacheMaxBytes = 32 * 1024
+        self.mws = mws
+        if server == 'async':
+            # Every client is a coroutine of one loop thread, /loop shows
+            # how much of it each one takes
+            asyncio.get_event_loop().enable_stats()
+            # Connection bursts beyond this get a 503 instead of heap
+            mws.AsyncMaxClients = app_config.get('max_clients', 8)
+            mws.StartAsync(threaded=True)
+        else:
+            # Streams keep a worker busy, one is always left for control
+            # requests (MicroWebSrv.AcquireStream)
+            mws.Start(threaded=True, maxWorkers=app_config.get('workers', 4), maxQueued=2)
+        gc.collect()
 
-        elif app_config['camera'] == 'M5CAMERA':
-            camera.init(0, format=camera.JPEG, framesize=self.framesize, d0=32, d1=35, d2=34, d3=5, d4=39, 
-                    d5=18, d6=36, d7=19, href=26, vsync=25, reset=15, sioc=23, siod=22, xclk=27, pclk=21)   #M5CAMERA  
+    def _cameraReinit(self):
+        # The sensor is back to its defaults
+        self.settings.reapply()
+        self.adaptive.reset(self.settings['quality'], self.settings['framesize'])
 
+    def _writeUnavailable(self, httpResponse):
+        # Fail fast while the watchdog recovers the camera
+        headers = { 'Retry-After' : self.watchdog.retry_after() or 1 }
+        httpResponse.WriteResponse(code=503, headers=headers,
+                                    contentType="text/plain",
+                                    contentCharset="UTF-8",
+                                    content="Camera unavailable")
 
-        mws = MicroWebSrv(routeHandlers=self.routeHandlers, webPath="www/")
-        mws.Start(threaded=True)
-        gc.collect()
+    def _writeBusy(self, httpResponse):
+        # Every stream slot is taken, the last worker stays for the others
+        httpResponse.WriteResponse(code=503, headers={ 'Retry-After' : 1 },
+                                    contentType="text/plain",
+                                    contentCharset="UTF-8",
+                                    content="Too many streams")
 
-    def _httpStream(self, httpClient, httpResponse, routeArgs):
-        image = camera.capture()
+    def _writeSnapshot(self, httpClient, httpResponse, frame):
+        if frame is None:
+            self._writeUnavailable(httpResponse)
+            return
 
-        headers = { 'Last-Modified' : 'Fri, 1 Jan 2018 23:42:00 GMT', \
-                    'Cache-Control' : 'no-cache, no-store, must-revalidate' }
+        # Pollers faster than the sensor revalidate instead of downloading
+        # the same frame again
+        etag = '"%d-%d"' % (self.hub.epoch, frame.seq)
+        headers = { 'ETag' : etag, \
+                    'Cache-Control' : 'no-cache' }
+
+        if etag in httpClient.GetRequestHeaders().get('if-none-match', ''):
+            httpResponse.WriteResponseNotModified(headers=headers)
+            return
 
         httpResponse.WriteResponse(code=200, headers=headers,
                                     contentType="image/jpeg",
                                     contentCharset="UTF-8",
-                                    content=image)
+                                    content=frame.buf)
 
+    def _httpStream(self, httpClient, httpResponse, routeArgs):
+        frame = self.hub.get()
+        try:
+            self._writeSnapshot(httpClient, httpResponse, frame)
+        finally:
+            self.hub.release(frame)
+
+    def _httpStreamAsync(self, httpClient, httpResponse, routeArgs):
+        frame = yield from self.hub.aget()
+        try:
+            self._writeSnapshot(httpClient, httpResponse, frame)
+            # The frame is referenced until it is sent
+            yield from httpResponse.Flush()
+        finally:
+            self.hub.release(frame)
+
+
+    def _frameNextArgs(self, httpClient, httpResponse):
+        # /frame/next?after=<seq>&timeout=<ms> waits for a frame newer than
+        # <seq>, clients pass back the X-Frame-Seq of the last one they got
+        params = httpClient.GetRequestQueryParams()
+        try:
+            after = int(params.get('after', 0))
+            timeout = min(int(params.get('timeout', 10000)), 30000)
+        except ValueError:
+            httpResponse.WriteResponseBadRequest()
+            return None
+
+        # A sequence number from before a reboot is in the future
+        latest = self.hub.latest()
+        if after > (latest.seq if latest else 0):
+            after = 0
+        return after, timeout
+
+    def _httpFrameNext(self, httpClient, httpResponse):
+        args = self._frameNextArgs(httpClient, httpResponse)
+        if args is None:
+            return
+        # A long poll holds its worker like a stream
+        if not self.mws.AcquireStream():
+            self._writeBusy(httpResponse)
+            return
+        try:
+            frame = self.hub.get(args[0], timeout_ms=args[1])
+            try:
+                self._writeFrameNext(httpResponse, frame)
+            finally:
+                self.hub.release(frame)
+        finally:
+            self.mws.ReleaseStream()
+
+    def _httpFrameNextAsync(self, httpClient, httpResponse):
+        args = self._frameNextArgs(httpClient, httpResponse)
+        if args is None:
+            return
+        frame = yield from self.hub.aget(args[0], timeout_ms=args[1])
+        try:
+            self._writeFrameNext(httpResponse, frame)
+            yield from httpResponse.Flush()
+        finally:
+            self.hub.release(frame)
+
+    def _writeFrameNext(self, httpResponse, frame):
+        if frame is None and self.watchdog.recovering:
+            self._writeUnavailable(httpResponse)
+            return
+        if frame is None:
+            # Nothing new yet, the client simply asks again
+            httpResponse.WriteResponse(code=204, headers=None,
+                                        contentType=None,
+                                        contentCharset=None,
+                                        content=None)
+            return
+
+        headers = { 'X-Frame-Seq' : frame.seq, \
+                    'ETag' : '"%d-%d"' % (self.hub.epoch, frame.seq), \
+                    'Cache-Control' : 'no-cache, no-store, must-revalidate' }
+        httpResponse.WriteResponse(code=200, headers=headers,
+                                    contentType="image/jpeg",
+                                    contentCharset="UTF-8",
+                                    content=frame.buf)
+
+
+    def _mjpegStart(self, httpClient, httpResponse):
+        # /mjpeg?fps=<max frames per second>&framesize=<camera.FRAME_*>,
+        # returns the interval between frames or None
+        params = httpClient.GetRequestQueryParams()
+        try:
+            fps = int(params.get('fps', 0))
+            if 'framesize' in params:
+                # The sensor is shared, a new frame size applies to every viewer
+                self._updateSettings({'framesize': params['framesize']})
+        except ValueError:
+            httpResponse.WriteResponseBadRequest()
+            return None
+
+        if self.watchdog.recovering:
+            self._writeUnavailable(httpResponse)
+            return None
+
+        headers = { 'Cache-Control' : 'no-cache, no-store, must-revalidate' }
+        if not httpResponse.WriteResponseMultipartStart('frame', headers):
+            return None
+        return 1000 // fps if fps > 0 else 0
+
+    def _httpMjpeg(self, httpClient, httpResponse):
+        if not self.mws.AcquireStream():
+            self._writeBusy(httpResponse)
+            return
+        try:
+            self._serveMjpeg(httpClient, httpResponse)
+        finally:
+            self.mws.ReleaseStream()
+
+    def _serveMjpeg(self, httpClient, httpResponse):
+        interval = self._mjpegStart(httpClient, httpResponse)
+        if interval is None:
+            return
+
+        # A slow viewer skips frames, it never holds back the others
+        viewer = Viewer(self.hub, '%s:%d' % (httpClient.GetIPAddr(), httpClient.GetPort()))
+        try:
+            while True:
+                sent = ticks_ms()
+                frame = viewer.get()
+                if frame is None:
+                    break
+                if not httpResponse.WriteResponseMultipartPart('frame', 'image/jpeg', frame.buf):
+                    break
+                viewer.done()
+                if interval:
+                    wait = interval - ticks_diff(ticks_ms(), sent)
+                    if wait > 0:
+                        sleep_ms(wait)
+        finally:
+            viewer.close()
+
+    def _httpMjpegAsync(self, httpClient, httpResponse):
+        interval = self._mjpegStart(httpClient, httpResponse)
+        if interval is None:
+            return
+
+        viewer = Viewer(self.hub, '%s:%d' % (httpClient.GetIPAddr(), httpClient.GetPort()))
+        try:
+            while True:
+                sent = ticks_ms()
+                frame = yield from viewer.aget()
+                if frame is None:
+                    break
+                if not httpResponse.WriteResponseMultipartPart('frame', 'image/jpeg', frame.buf):
+                    break
+                if not (yield from httpResponse.Flush()):
+                    break
+                viewer.done()
+                if interval:
+                    wait = interval - ticks_diff(ticks_ms(), sent)
+                    if wait > 0:
+                        yield from asyncio.sleep_ms(wait)
+        finally:
+            viewer.close()
 
-    def _httpLogo(self, httpClient, httpResponse):
-        f = open("www/logo.svg", "r")
-        content =  f.read()
-        f.close()
 
-        httpResponse.WriteResponseOk(headers=None,
+    def _httpLogo(self, httpClient, httpResponse):
+        httpResponse.WriteResponseStaticFile("www/logo.svg",
                                     contentType="image/svg+xml",
-                                    contentCharset="UTF-8",
-                                    content=content)
+                                    contentCharset="UTF-8")
 
 
     def _httpHandlerIndex(self, httpClient, httpResponse):
-        f = open("www/index.html", "r")
-        content =  f.read()
-        f.close()
-
-        headers = { 'Last-Modified' : 'Fri, 1 Jan 2018 23:42:00 GMT', \
-                            'Cache-Control' : 'no-cache, no-store, must-revalidate' }
-
-        httpResponse.WriteResponseOk(headers=None,
+        httpResponse.WriteResponseStaticFile("www/index.html",
                                     contentType="text/html",
-                                    contentCharset="UTF-8",
-                                    content=content)
+                                    contentCharset="UTF-8")
+
+    def _updateSettings(self, changes):
+        # Only the changed values reach the sensor, at the next frame boundary
+        changed = self.settings.update(changes)
+        if 'quality' in changed or 'framesize' in changed:
+            self.adaptive.reset(self.settings['quality'], self.settings['framesize'])
 
     def _httpHandlerSetData(self, httpClient, httpResponse, routeArgs):
-        self.saturation = int(routeArgs['saturation']) - 2
-        self.brightness = int(routeArgs['brightness']) - 2 
-        self.contrast = int(routeArgs['contrast']) - 2
-        self.quality = int(routeArgs['quality'])
-        self.vflip = bool(routeArgs['vflip'])
-        self.hflip = bool(routeArgs['hflip'])
-        self.framesize = int(routeArgs['framesize'])
-
-        camera.saturation(self.saturation)
-        camera.brightness(self.brightness)
-        camera.contrast(self.contrast)
-        camera.quality(self.quality)
-        camera.flip(self.vflip)
-        camera.mirror(self.hflip)
-        camera.framesize(self.framesize)
+        # Sliders of index.html, shifted to be positive
+        try:
+            self._updateSettings({
+                'saturation': int(routeArgs['saturation']) - 2,
+                'brightness': int(routeArgs['brightness']) - 2,
+                'contrast': int(routeArgs['contrast']) - 2,
+                'quality': routeArgs['quality'],
+                'vflip': routeArgs['vflip'],
+                'hflip': routeArgs['hflip'],
+                'framesize': routeArgs['framesize']
+            })
+        except ValueError:
+            httpResponse.WriteResponseBadRequest()
+            return
 
-        data = {
-            'saturation': self.saturation,
-            'brightness': self.brightness,
-            'contrast': self.contrast,
-            'quality': self.quality,
-            'vflip': self.vflip,
-            'hflip': self.hflip,
-            'framesize': self.framesize
-        }
-        self._newdata = True
         httpResponse.WriteResponseOk(headers=None,
                                         contentType="text/html",
                                         contentCharset="UTF-8",
-                                        content=json.dumps(data))
+                                        content=json.dumps(self.settings.values))
+
+    def _httpHandlerPostData(self, httpClient, httpResponse):
+        # Partial update, e.g. {"quality": 20}
+        changes = httpClient.ReadRequestContentAsJSON()
+        try:
+            if type(changes) is not dict:
+                raise ValueError('Expected a JSON object')
+            self._updateSettings(changes)
+        except ValueError as ex:
+            # Shown by the page, nothing was changed
+            httpResponse.WriteResponse(code=400, headers=None,
+                                        contentType="text/plain",
+                                        contentCharset="UTF-8",
+                                        content=str(ex))
+            return
+
+        httpResponse.WriteResponseJSONOk(obj=self.settings.values)
 
     def _httpHandlerGetData(self, httpClient, httpResponse):
+        data = dict(self.settings.values)
+        data['adaptive'] = self.adaptive.status()
+
+        httpResponse.WriteResponseOk(headers=None,
+                                    contentType="application/json",
+                                    contentCharset="UTF-8",
+                                    content=json.dumps(data))
+
+    def _httpHandlerAdaptive(self, httpClient, httpResponse):
+        # /upy/adaptive?fps=<target fps>&bytes=<bytes/s budget>, 0 turns a
+        # target off and with both off the user settings apply again
+        params = httpClient.GetRequestQueryParams()
+        try:
+            fps = int(params['fps']) if 'fps' in params else None
+            max_bytes_s = int(params['bytes']) if 'bytes' in params else None
+        except ValueError:
+            httpResponse.WriteResponseBadRequest()
+            return
+
+        self.adaptive.configure(fps, max_bytes_s)
+        httpResponse.WriteResponseOk(headers=None,
+                                    contentType="application/json",
+                                    contentCharset="UTF-8",
+                                    content=json.dumps(self.adaptive.status()))
+
+    def _httpHandlerViewers(self, httpClient, httpResponse):
         data = {
-            'saturation': self.saturation,
-            'brightness': self.brightness,
-            'contrast': self.contrast,
-            'quality': self.quality,
-            'vflip': self.vflip,
-            'hflip': self.hflip,
-            'framesize': self.framesize
+            'captures': self.hub.captures,
+            'failures': self.hub.failures,
+            'skipped': self.hub.skipped,
+            'viewers': [viewer.stats() for viewer in list(self.hub.viewers)],
+            'camera': self.watchdog.status()
         }
 
         httpResponse.WriteResponseOk(headers=None,
@@ -140,6 +410,20 @@ class webcam():
                                     contentCharset="UTF-8",
                                     content=json.dumps(data))
 
+    def _httpHandlerLoop(self, httpClient, httpResponse):
+        # Event loop and accept counters of the async server
+        data = asyncio.get_event_loop().stats_snapshot() if asyncio else None
+        if data is None:
+            httpResponse.WriteResponseNotFound()
+            return
+        if self.mws.AsyncStats:
+            data['server'] = self.mws.AsyncStats.snapshot()
+
+        httpResponse.WriteResponseOk(headers=None,
+                                    contentType="application/json",
+                                    contentCharset="UTF-8",
+                                    content=json.dumps(data))
+
     def _httpHandlerMemory(self, httpClient, httpResponse, routeArgs):
         print("In Memory HTTP variable route :")
         query = str(routeArgs['query'])